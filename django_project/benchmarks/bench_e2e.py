@@ -0,0 +1,232 @@
+"""End-to-end benchmark of translate_epub against a local fake LLM endpoint.
+
+Generates a synthetic EPUB or IDML, starts benchmarks/fake_openai.py in this
+process and runs the translate_epub command in a child process twice: cold
+(every paragraph new) and warm (everything already stored).  Each run reports
+wall time, database queries, peak RSS and LLM requests, plus the stage
+timings from the command's --metrics_json.
+
+usage: python benchmarks/bench_e2e.py [--format epub] [--documents 10] [--paragraphs 100]
+                                      [--latency 0.2] [--jitter 0.1] [--error_rate 0.01]
+                                      [--database sqlite] [--compare benchmarks/results/previous.json]
+                                      [-- extra translate_epub options, e.g. --batch_size 10]
+
+Runs on a throwaway database: by default a SQLite file in a temporary
+directory, or with --database configured a test copy (test_<DB_NAME>_bench)
+of the database in translate_epub/.env, dropped afterwards.  Results are
+written to benchmarks/results/ as JSON; --compare prints the change against
+an earlier result file.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_openai import FakeOpenAIServer  # noqa: E402
+from synthetic import write_epub, write_idml  # noqa: E402
+
+METRICS = ('wall_seconds', 'queries', 'peak_rss_mb', 'requests')
+
+
+def setup_django():
+    sys.path.insert(0, PROJECT_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'translate_epub.settings')
+    import django
+    django.setup()
+
+
+def run_database(action, languages):
+    """Create and migrate, or drop, the database the runs use."""
+    setup_django()
+    from django.core.management import call_command
+    from django.db import connection
+
+    if os.environ.get('BENCH_SQLITE_PATH'):
+        # A file in the run's temporary directory, removed with it
+        if action == 'create':
+            call_command('migrate', verbosity=0)
+        name = connection.settings_dict['NAME']
+    else:
+        name = connection.settings_dict['NAME']
+        name = f'{name}.bench' if connection.vendor == 'sqlite' else f'test_{name}_bench'
+        if action == 'drop':
+            # destroy_test_db drops the database named in NAME
+            connection.settings_dict['NAME'] = name
+            connection.creation.destroy_test_db(verbosity=0)
+        else:
+            connection.settings_dict['TEST']['NAME'] = name
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    if action == 'drop':
+        return
+    # The IDML path expects the target languages to exist
+    from translate_epub.models import Language
+    for language in languages:
+        Language.objects.get_or_create(name=language)
+    print(json.dumps({'name': name}))
+
+
+def run_database_command(action, env, languages=()):
+    completed = subprocess.run(
+        [sys.executable, __file__, '--database_command', action, '--', *languages],
+        env=env, capture_output=True, text=True,
+    )
+    if completed.returncode:
+        sys.stderr.write(completed.stderr)
+        raise SystemExit(f'could not {action} the benchmark database')
+    return completed.stdout
+
+
+def run_child(arguments):
+    """Run translate_epub in this process, counting queries on the main connection."""
+    setup_django()
+    from django.core.management import call_command
+    from django.db import connection
+
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    with connection.execute_wrapper(count_queries):
+        call_command('translate_epub', *arguments)
+    wall = time.perf_counter() - started
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({'wall_seconds': round(wall, 3), 'queries': queries, 'peak_rss_mb': round(peak_rss, 1)}))
+
+
+def run(server, arguments, metrics_path, env):
+    requests_before = server.stats()
+    completed = subprocess.run(
+        [sys.executable, __file__, '--child', '--', *arguments, '--metrics_json', metrics_path],
+        cwd=os.path.dirname(metrics_path),
+        env={**env, 'API_BASE': server.base_url, 'API_KEY': 'benchmark'},
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode:
+        sys.stderr.write(completed.stderr)
+        raise SystemExit(f'translate_epub failed with exit code {completed.returncode}')
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result['requests'] = server.stats() - requests_before
+    with open(metrics_path) as f:
+        result['telemetry'] = json.load(f)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True,
+        ).stdout.strip()
+    except OSError:
+        return ''
+
+
+def print_result(name, result, previous=None):
+    line = (
+        f"{name:<6} wall {result['wall_seconds']:8.2f}s   queries {result['queries']:7d}   "
+        f"peak RSS {result['peak_rss_mb']:7.1f} MB   requests {result['requests']:6d}"
+    )
+    if previous:
+        changes = [
+            f"{metric} {(result[metric] - previous[metric]) / previous[metric] * 100:+.0f}%"
+            for metric in METRICS if previous.get(metric)
+        ]
+        line += f"   ({', '.join(changes)})"
+    print(line)
+
+
+def main():
+    if '--child' in sys.argv:
+        run_child(sys.argv[sys.argv.index('--') + 1:])
+        return
+    if '--database_command' in sys.argv:
+        run_database(sys.argv[sys.argv.index('--database_command') + 1], sys.argv[sys.argv.index('--') + 1:])
+        return
+
+    extra = []
+    if '--' in sys.argv:
+        extra = sys.argv[sys.argv.index('--') + 1:]
+        sys.argv = sys.argv[:sys.argv.index('--')]
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--format', choices=('epub', 'idml'), default='epub')
+    parser.add_argument('--documents', type=int, default=10)
+    parser.add_argument('--paragraphs', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--lang_from', default='English')
+    parser.add_argument('--lang_to', default='Benchmarkish', help='one language, or several separated by commas')
+    parser.add_argument('--database', choices=('sqlite', 'configured'), default='sqlite',
+                        help='a temporary SQLite file, or a test copy of the database in .env')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(0, args.latency, args.jitter, args.error_rate).start()
+    seed = uuid.uuid4().hex[:8]
+    results = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'parameters': {**vars(args), 'extra': extra},
+        'runs': {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            'PYTHONPATH': os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get('PYTHONPATH')])),
+            'DJANGO_SETTINGS_MODULE': 'bench_settings',
+            'BENCH_BASE_SETTINGS': os.environ.get('DJANGO_SETTINGS_MODULE', 'translate_epub.settings'),
+        }
+        if args.database == 'sqlite':
+            env['BENCH_SQLITE_PATH'] = os.path.join(directory, 'bench.sqlite3')
+        languages = [name.strip() for name in args.lang_to.split(',')] if args.format == 'idml' else []
+        database = json.loads(run_database_command('create', env, languages).strip().splitlines()[-1])['name']
+        print(f'Database: {database}')
+        run_env = {**env, 'BENCH_DATABASE_NAME': database} if args.database == 'configured' else env
+
+        try:
+            book_path = os.path.join(directory, f'bench_{seed}.{args.format}')
+            (write_idml if args.format == 'idml' else write_epub)(book_path, args.documents, args.paragraphs, seed)
+            megabytes = os.path.getsize(book_path) / (1024 * 1024)
+            print(f'{book_path}: {args.documents} documents x {args.paragraphs} paragraphs, {megabytes:.2f} MB')
+
+            arguments = ['--book_name', book_path, '--lang_from', args.lang_from, '--lang_to', args.lang_to, *extra]
+            for name in ('cold', 'warm'):
+                results['runs'][name] = run(server, arguments, os.path.join(directory, f'{name}.json'), run_env)
+        finally:
+            run_database_command('drop', env)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['runs']
+    for name, result in results['runs'].items():
+        print_result(name, result, previous.get(name) if previous else None)
+
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR, 'results', f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{args.format}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Parse and serialize throughput for epub documents.
+
+Compares the old pipeline (two html.parser passes, one for classification and
+one for extraction, then prettify()) with the single-pass pipeline TEPUB uses
+now (one parse with the chosen tree builder, then encode()).
+
+usage: python benchmarks/bench_parsing.py [book.epub] [--repeat N] [--parser lxml]
+
+Without an epub a synthetic XHTML chapter of about 1 MB is used.
+"""
+import argparse
+import time
+import warnings
+import zipfile
+
+from bs4 import BeautifulSoup as bs, XMLParsedAsHTMLWarning
+
+warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
+
+ELEMENT_TYPES = ['h1', 'h2', 'h3', 'h4', 'p', 'li']
+
+
+def synthetic_document(size=1024 * 1024):
+    paragraph = (
+        '<p class="body">Lorem ipsum dolor sit amet, <em>consectetur</em> adipiscing elit, '
+        'sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.</p>\n'
+    )
+    body = ['<h1>Chapter 1</h1>\n<h2>The beginning</h2>\n']
+    while sum(len(part) for part in body) < size:
+        body.append(paragraph)
+        body.append('<ul><li>first item</li><li>second item</li></ul>\n')
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter 1</title></head>'
+        f'<body>{"".join(body)}</body></html>'
+    ).encode()
+
+
+def epub_documents(path):
+    with zipfile.ZipFile(path) as zip_ref:
+        return [
+            zip_ref.read(name) for name in zip_ref.namelist()
+            if name.endswith(('.xhtml', '.html', '.htm'))
+        ]
+
+
+def before(content):
+    started = time.perf_counter()
+    soup = bs(content, 'html.parser')
+    soup.find('h1')
+    soup.find('h2')
+    soup = bs(content, 'html.parser')
+    soup.findAll(ELEMENT_TYPES)
+    parsed = time.perf_counter()
+    soup.prettify().encode()
+    return parsed - started, time.perf_counter() - parsed
+
+
+def after(content, parser):
+    started = time.perf_counter()
+    soup = bs(content, parser)
+    soup.find('h1')
+    soup.find('h2')
+    soup.findAll(ELEMENT_TYPES)
+    parsed = time.perf_counter()
+    soup.encode()
+    return parsed - started, time.perf_counter() - parsed
+
+
+def run(name, documents, repeat, measure):
+    megabytes = sum(len(document) for document in documents) / (1024 * 1024)
+    parse_time = serialize_time = 0.0
+    for _ in range(repeat):
+        for document in documents:
+            parse_seconds, serialize_seconds = measure(document)
+            parse_time += parse_seconds
+            serialize_time += serialize_seconds
+    parse_per_mb = parse_time / repeat / megabytes
+    serialize_per_mb = serialize_time / repeat / megabytes
+    print(f'{name:<28} parse {parse_per_mb * 1000:8.1f} ms/MB   serialize {serialize_per_mb * 1000:8.1f} ms/MB')
+    return parse_per_mb + serialize_per_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('epub', nargs='?')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--parser', default='lxml')
+    args = parser.parse_args()
+
+    documents = epub_documents(args.epub) if args.epub else [synthetic_document()]
+    megabytes = sum(len(document) for document in documents) / (1024 * 1024)
+    print(f'{len(documents)} document(s), {megabytes:.2f} MB, {args.repeat} repeat(s)')
+
+    old = run('html.parser x2 + prettify', documents, args.repeat, before)
+    new = run(f'{args.parser} x1 + encode', documents, args.repeat, lambda document: after(document, args.parser))
+    print(f'speedup: {old / new:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Settings for bench_e2e.py runs: the usual settings on a throwaway database.
+
+BENCH_BASE_SETTINGS names the settings module to start from (translate_epub's
+by default).  BENCH_SQLITE_PATH replaces the database with a SQLite file;
+BENCH_DATABASE_NAME keeps the configured server but uses another database on it.
+"""
+import copy
+import os
+from importlib import import_module
+
+from django.db.backends.signals import connection_created
+
+_base = import_module(os.environ.get('BENCH_BASE_SETTINGS') or 'translate_epub.settings')
+globals().update({name: value for name, value in vars(_base).items() if name.isupper()})
+
+DATABASES = copy.deepcopy(_base.DATABASES)
+if os.environ.get('BENCH_SQLITE_PATH'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ['BENCH_SQLITE_PATH'],
+            # The LLM worker threads and the writer share the file
+            'OPTIONS': {'timeout': 30},
+        }
+    }
+elif os.environ.get('BENCH_DATABASE_NAME'):
+    DATABASES['default']['NAME'] = os.environ['BENCH_DATABASE_NAME']
+
+
+def add_collations(sender, connection, **kwargs):
+    # Stand-ins for the MySQL collations some columns declare
+    if connection.vendor == 'sqlite':
+        for name in ('utf8mb4_unicode_ci', 'utf8mb4_bin'):
+            connection.connection.create_collation(name, lambda a, b: (a > b) - (a < b))
+
+
+connection_created.connect(add_collations)
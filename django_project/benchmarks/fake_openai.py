@@ -0,0 +1,160 @@
+"""Local stand-in for an OpenAI-compatible chat completions endpoint.
+
+Answers every request after a configurable latency (plus random jitter) and
+fails a configurable fraction of them with 429 or 500, so the scheduler's
+retries show up in benchmarks.  Translations are the source text prefixed
+with "[xx] "; batched JSON-array prompts get a JSON array back, and
+multi-language prompts an array of {language: translation} objects.
+Requests with "stream": true are answered with server-sent chunks, one
+word at a time.
+
+usage: python benchmarks/fake_openai.py [--port 5055] [--latency 0.2] [--jitter 0.1] [--error_rate 0.01]
+
+GET /stats returns the number of requests received so far.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LANGUAGES_PATTERN = re.compile(r'into each of these languages: (.*?)\. Return.*?(\[.*\])\s*$', re.DOTALL)
+BATCH_PATTERN = re.compile(r'JSON array.*?(\[.*\])\s*$', re.DOTALL)
+SINGLE_PATTERN = re.compile(r'\n (.*?): (.*)\n[^\n]*:$', re.DOTALL)
+
+
+def translate_prompt(prompt):
+    match = LANGUAGES_PATTERN.search(prompt)
+    if match:
+        languages = match.group(1).split(', ')
+        return json.dumps(
+            [{language: f'[xx] {text}' for language in languages} for text in json.loads(match.group(2))],
+            ensure_ascii=False,
+        )
+    match = BATCH_PATTERN.search(prompt)
+    if match:
+        return json.dumps([f'[xx] {text}' for text in json.loads(match.group(1))], ensure_ascii=False)
+    match = SINGLE_PATTERN.search(prompt)
+    if match:
+        return f'[xx] {match.group(2)}'
+    return 'This is an answer, streamed one word at a time.'
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, request, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        for piece in re.findall(r'\S+\s*', content):
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': request.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}],
+            }
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.server.latency / 10)
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def do_GET(self):
+        self.send_json(200, {'requests': self.server.stats()})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.count()
+        time.sleep(max(0.0, self.server.latency + random.uniform(-self.server.jitter, self.server.jitter)))
+
+        if random.random() < self.server.error_rate:
+            if random.random() < 0.5:
+                self.send_json(429, {'error': {'message': 'rate limited', 'type': 'rate_limit'}}, {'Retry-After': '0'})
+            else:
+                self.send_json(500, {'error': {'message': 'server error', 'type': 'server_error'}})
+            return
+
+        prompt = request['messages'][-1]['content']
+        content = translate_prompt(prompt)
+        if request.get('stream'):
+            self.send_stream(request, content)
+            return
+        self.send_json(200, {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': len(prompt) // 4 + 1,
+                'completion_tokens': len(content) // 4 + 1,
+                'total_tokens': len(prompt) // 4 + len(content) // 4 + 2,
+            },
+        })
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.2, jitter=0.1, error_rate=0.0):
+        super().__init__(('127.0.0.1', port), FakeOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def stats(self):
+        with self.lock:
+            return self.requests
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(args.port, args.latency, args.jitter, args.error_rate)
+    print(f'Serving on {server.base_url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Synthetic EPUB and IDML files of a chosen size, for benchmarks.
+
+usage: python benchmarks/synthetic.py book.epub --documents 20 --paragraphs 200
+       python benchmarks/synthetic.py book.idml --documents 50 --paragraphs 100
+
+Every paragraph is distinct (it carries ``seed`` and its position), so the
+translation memory can't short-circuit a run unless the seed is reused.
+"""
+import argparse
+import zipfile
+
+SENTENCES = [
+    'The morning light crept slowly across the valley.',
+    'Nobody in the village remembered when the bridge was built.',
+    'She folded the letter twice and put it in her pocket.',
+    'Rain had fallen for three days without a pause.',
+    'At the end of the road stood a house with green shutters.',
+]
+
+
+def paragraph(seed, document, index):
+    sentences = ' '.join(SENTENCES[(document + index + n) % len(SENTENCES)] for n in range(3))
+    return f'{sentences} ({seed} {document}.{index})'
+
+
+def write_epub(path, documents=10, paragraphs=100, seed='s'):
+    chapters = [f'chapter_{n}.xhtml' for n in range(documents)]
+    manifest = ''.join(
+        f'<item id="chapter_{n}" href="{name}" media-type="application/xhtml+xml"/>'
+        for n, name in enumerate(chapters)
+    )
+    spine = ''.join(f'<itemref idref="chapter_{n}"/>' for n in range(documents))
+    nav_items = ''.join(f'<li><a href="{name}">Chapter {n + 1}</a></li>' for n, name in enumerate(chapters))
+
+    with zipfile.ZipFile(path, 'w') as zip_ref:
+        zip_ref.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        zip_ref.writestr(
+            'META-INF/container.xml',
+            '<?xml version="1.0"?>'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>',
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        zip_ref.writestr(
+            'OEBPS/content.opf',
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="id">synthetic-{seed}</dc:identifier><dc:title>Synthetic {seed}</dc:title>'
+            '<dc:language>en</dc:language></metadata>'
+            '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            f'{manifest}</manifest><spine>{spine}</spine></package>',
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        zip_ref.writestr(
+            'OEBPS/nav.xhtml',
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+            f'<head><title>Contents</title></head><body><nav epub:type="toc"><ol>{nav_items}</ol></nav>'
+            '</body></html>',
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        for n, name in enumerate(chapters):
+            body = ''.join(f'<p>{paragraph(seed, n, index)}</p>\n' for index in range(paragraphs))
+            zip_ref.writestr(
+                f'OEBPS/{name}',
+                '<?xml version="1.0" encoding="utf-8"?>'
+                f'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter {n + 1}</title></head>'
+                f'<body><h1>Chapter {n + 1}</h1>\n{body}</body></html>',
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+
+
+def write_idml(path, documents=10, paragraphs=100, seed='s'):
+    with zipfile.ZipFile(path, 'w') as zip_ref:
+        zip_ref.writestr('mimetype', 'application/vnd.adobe.indesign-idml-package', compress_type=zipfile.ZIP_STORED)
+        stories = ''.join(f'<idPkg:Story src="Stories/Story_u{n}.xml"/>' for n in range(documents))
+        zip_ref.writestr(
+            'designmap.xml',
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Document xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="8.0">'
+            f'{stories}</Document>',
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        for n in range(documents):
+            ranges = ''.join(
+                '<ParagraphStyleRange><CharacterStyleRange>'
+                f'<Content>{paragraph(seed, n, index)}</Content><Br/>'
+                '</CharacterStyleRange></ParagraphStyleRange>'
+                for index in range(paragraphs)
+            )
+            zip_ref.writestr(
+                f'Stories/Story_u{n}.xml',
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<idPkg:Story xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging" DOMVersion="8.0">'
+                f'<Story Self="u{n}">{ranges}</Story></idPkg:Story>',
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--documents', type=int, default=10)
+    parser.add_argument('--paragraphs', type=int, default=100)
+    parser.add_argument('--seed', default='s')
+    args = parser.parse_args()
+
+    write = write_idml if args.path.endswith('.idml') else write_epub
+    write(args.path, args.documents, args.paragraphs, args.seed)
+
+
+if __name__ == '__main__':
+    main()
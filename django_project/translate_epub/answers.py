@@ -0,0 +1,238 @@
+import asyncio
+import environ
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .chatgpt import API_MODEL, ChatGPT
+from .models import Answer, AnswerCache, Question, hash_content
+from .passage_index import build_context
+from .translation_memory import normalize_text
+
+env = environ.Env()
+environ.Env.read_env()
+
+# Passages sent with a question, and their token budget
+ASK_TOP_K = 8
+ASK_MAX_TOKENS = 3000
+# How often a generation saves the text received so far
+ANSWER_SAVE_SECONDS = 1.0
+# How often a generation touches its row while it waits (for the context, the scheduler or the first token)
+ANSWER_HEARTBEAT_SECONDS = 5
+# An unfinished answer that hasn't been saved for this long lost its generation and is started again
+ANSWER_STALE_SECONDS = 30
+# How often a stream following another process's generation checks the database
+ANSWER_POLL_SECONDS = 0.5
+# Answers kept for repeated questions; least recently used ones go first, and none is reused
+# once it is older than the maximum age.  0 entries turns the cache off.
+ANSWER_CACHE_MAX_ENTRIES = env.int('ANSWER_CACHE_MAX_ENTRIES', default=10000)
+ANSWER_CACHE_MAX_AGE_DAYS = env.int('ANSWER_CACHE_MAX_AGE_DAYS', default=30)
+
+# Generations running on this process's event loop, by answer id
+generations = {}
+
+
+async def question_context(book_items, question):
+    return await sync_to_async(build_context)(book_items, question, ASK_TOP_K, ASK_MAX_TOKENS)
+
+
+def answer_key(question, context, model=API_MODEL):
+    """Cache key of a question asked with ``context``, as returned by question_context.
+
+    The context holds the source text of the passages the model would see, so
+    a cached answer stops matching once one of those chapters changes, or once
+    an edit (of a translation too) makes the question retrieve other passages.
+    """
+    parts = [normalize_text(question).casefold(), hash_content(context), model]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def cache_cutoff():
+    return timezone.now() - timedelta(days=ANSWER_CACHE_MAX_AGE_DAYS)
+
+
+async def cached_answer(key):
+    """The cached answer for ``key``, or None."""
+    if not ANSWER_CACHE_MAX_ENTRIES:
+        return None
+    entry = await AnswerCache.objects.filter(key=key, created_at__gte=cache_cutoff()).only('content').afirst()
+    if entry is None:
+        return None
+    await AnswerCache.objects.filter(pk=entry.pk).aupdate(hit_count=F('hit_count') + 1, last_used_at=timezone.now())
+    return entry.content
+
+
+async def store_answer(key, question, content):
+    if not ANSWER_CACHE_MAX_ENTRIES:
+        return
+    await AnswerCache.objects.aupdate_or_create(
+        key=key,
+        defaults={'model': API_MODEL, 'question': question, 'content': content, 'last_used_at': timezone.now()},
+    )
+    await evict_answers()
+
+
+async def evict_answers():
+    await AnswerCache.objects.filter(created_at__lt=cache_cutoff()).adelete()
+    excess = await AnswerCache.objects.acount() - ANSWER_CACHE_MAX_ENTRIES
+    if excess > 0:
+        # MySQL can't delete with a LIMIT subquery
+        oldest = [pk async for pk in AnswerCache.objects.order_by('last_used_at').values_list('pk', flat=True)[:excess]]
+        await AnswerCache.objects.filter(pk__in=oldest).adelete()
+
+
+class AnswerGeneration:
+    """Streams one answer from the LLM as a task on the event loop, independent of any request.
+
+    Pieces of the answer are kept in memory for streams in this process and
+    saved to the Answer row every ANSWER_SAVE_SECONDS for everyone else; the
+    row is marked complete when the model finishes.  Saves only go through
+    while the row still carries this generation's claim; once another process
+    has taken it over, the generation stops.
+    """
+
+    def __init__(self, answer_id, claimed_at):
+        self.answer_id = answer_id
+        self.claimed_at = claimed_at
+        self.text = ''
+        self.done = False
+        self.complete = False
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def save(self, **fields):
+        """Write the text so far; False if the answer has been claimed by another generation."""
+        return bool(await Answer.objects.filter(pk=self.answer_id, started_at=self.claimed_at).aupdate(
+            content=self.text, updated_at=timezone.now(), **fields
+        ))
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(ANSWER_HEARTBEAT_SECONDS)
+            if not await self.save():
+                self.task.cancel()
+                return
+
+    async def run(self, question, content=None):
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            failed = False
+            try:
+                if content is None:
+                    book_items = [book_item async for book_item in question.book_items.all()]
+                    content = await question_context(book_items, question.content)
+                last_save = time.monotonic()
+                async for piece in ChatGPT().ask_stream(content, question.content):
+                    self.text += piece
+                    self.notify()
+                    if time.monotonic() - last_save >= ANSWER_SAVE_SECONDS:
+                        if not await self.save():
+                            return
+                        last_save = time.monotonic()
+            except Exception as e:
+                print(f"An error occurred: {str(e)}")
+                self.text = f"An error occurred while processing your request: {str(e)}"
+                failed = True
+            heartbeat.cancel()
+            if not await self.save(complete=True):
+                return
+            self.complete = True
+            if not failed and self.text.strip():
+                await store_answer(answer_key(question.content, content), question.content, self.text)
+            print('Question:', question.content)
+            print('Answer:', self.text)
+        except asyncio.CancelledError:
+            # Stopped mid-answer (e.g. the server is shutting down); let the next viewer start it again
+            await asyncio.shield(self.save(started_at=None))
+            raise
+        finally:
+            heartbeat.cancel()
+            generations.pop(self.answer_id, None)
+            self.done = True
+            self.notify()
+
+    async def follow(self):
+        """Yield the answer so far, then each new piece as it arrives."""
+        sent = 0
+        while True:
+            changed = self.changed
+            if len(self.text) > sent:
+                yield self.text[sent:]
+                sent = len(self.text)
+            if self.done:
+                return
+            await changed.wait()
+
+
+async def start_generation(answer, context=None):
+    """Start streaming ``answer`` on this event loop, unless another generation is already on it.
+
+    ``context`` is the question's context if the caller has already built it.
+
+    The Answer row is claimed with a conditional update, so of several
+    processes (or requests) trying at once exactly one starts it.
+    """
+    if answer.pk in generations:
+        return generations[answer.pk]
+    now = timezone.now()
+    claimed = await Answer.objects.filter(pk=answer.pk, complete=False).filter(
+        Q(started_at__isnull=True) | Q(updated_at__lt=now - timedelta(seconds=ANSWER_STALE_SECONDS))
+    ).aupdate(started_at=now, updated_at=now, content='')
+    if not claimed:
+        return None
+    generation = generations[answer.pk] = AnswerGeneration(answer.pk, now)
+    question = await Question.objects.aget(pk=answer.question_id)
+    generation.task = asyncio.create_task(generation.run(question, context))
+    return generation
+
+
+def sse(data, event=None):
+    message = f'data: {json.dumps(data)}\n\n'
+    return f'event: {event}\n{message}' if event else message
+
+
+async def stream_answer(answer):
+    """Server-sent events with the text of ``answer`` as it is produced, then a ``done`` event.
+
+    Pieces are appended to what was sent before; a ``reset`` event means the
+    answer was started again and the text so far should be dropped.
+    """
+    sent = 0
+    while True:
+        if not answer.complete:
+            generation = generations.get(answer.pk) or await start_generation(answer)
+            if generation is not None:
+                if sent:
+                    yield sse({}, event='reset')
+                    sent = 0
+                async for piece in generation.follow():
+                    yield sse({'text': piece})
+                    sent += len(piece)
+                if generation.complete:
+                    yield sse({'text': generation.text}, event='done')
+                    return
+                # Stopped or taken over before it finished; follow whoever picks it up
+                yield sse({}, event='reset')
+                sent = 0
+
+        # Finished, or being generated by another process: follow the row it saves
+        answer = await Answer.objects.aget(pk=answer.pk)
+        if len(answer.content) < sent:
+            yield sse({}, event='reset')
+            sent = 0
+        if len(answer.content) > sent:
+            yield sse({'text': answer.content[sent:]})
+            sent = len(answer.content)
+        if answer.complete:
+            yield sse({'text': answer.content}, event='done')
+            return
+        await asyncio.sleep(ANSWER_POLL_SECONDS)
@@ -0,0 +1,168 @@
+import logging
+import time
+from collections import Counter, defaultdict
+from itertools import chain
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import BookItem, BookItemElement, BookItemRender, BookTranslationStats, TranslationVersion
+from .passage_index import update_index
+from .telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+class TranslationWriter:
+    """Write-behind buffer for machine translations.
+
+    New elements, changed translations and their TranslationVersion rows are
+    collected in memory and written with bulk_create/bulk_update inside one
+    transaction every ``flush_every`` elements or ``flush_seconds`` seconds,
+    whichever comes first.  An interrupted run loses at most the open batch.
+    """
+
+    def __init__(self, flush_every=200, flush_seconds=10.0, user=None, is_machine_translation=True):
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.user = user
+        self.is_machine_translation = is_machine_translation
+        self.new_elements = []
+        self.updated_elements = []
+        self.versioned_elements = []
+        self.renders = []
+        # Changes to BookTranslationStats by (book_item_id, language_id)
+        self.stats = defaultdict(Counter)
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Whatever is buffered is already translated; keep it even if the run is aborting
+        if exc_type is None:
+            self.flush()
+            return
+        try:
+            self.flush()
+        except Exception:
+            # Don't let it replace the error the run is aborting with
+            logger.exception('Could not save the buffered translations')
+
+    def __len__(self):
+        return len(self.new_elements) + len(self.updated_elements)
+
+    def add(self, book_item_element):
+        """Queue an unsaved BookItemElement whose translated_content is already set."""
+        book_item_element.machine_translated = self.is_machine_translation
+        self.count(
+            book_item_element,
+            total=1,
+            complete=int(book_item_element.complete),
+            machine_translated=int(self.is_machine_translation),
+        )
+        self.new_elements.append(book_item_element)
+        self.versioned_elements.append(book_item_element)
+        self.maybe_flush()
+
+    def update(self, book_item_element, translated_content, source_changed=False):
+        """Queue a new translation for a stored element, like save_translation does.
+
+        Pass ``source_changed`` when the element's type, content or source_hash were
+        changed, so they are saved even if the translation comes out the same.
+        """
+        translation_changed = book_item_element.translated_content != translated_content
+        if not translation_changed and not source_changed:
+            return
+        book_item_element.translated_content = translated_content
+        self.updated_elements.append(book_item_element)
+        if translation_changed:
+            self.versioned_elements.append(book_item_element)
+            if book_item_element.machine_translated != self.is_machine_translation:
+                book_item_element.machine_translated = self.is_machine_translation
+                self.count(book_item_element, machine_translated=1 if self.is_machine_translation else -1)
+        self.maybe_flush()
+
+    def add_render(self, book_item, language, mirror, content_hash, content):
+        """Queue the rendered output of a document; saved after its elements."""
+        self.renders.append((book_item, language, mirror, content_hash, content))
+
+    def count(self, book_item_element, **changes):
+        self.stats[(book_item_element.book_item_id, book_item_element.language_id)].update(changes)
+
+    def maybe_flush(self):
+        if len(self) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if len(self) or self.renders:
+            with telemetry.stage('db'), transaction.atomic():
+                if self.new_elements:
+                    BookItemElement.objects.bulk_create(self.new_elements, batch_size=self.flush_every)
+                    self.load_primary_keys(self.new_elements)
+                if self.updated_elements:
+                    now = timezone.now()
+                    for book_item_element in self.updated_elements:
+                        book_item_element.updated_at = now
+                    BookItemElement.objects.bulk_update(
+                        self.updated_elements,
+                        ['element_type', 'content', 'source_hash', 'translated_content', 'machine_translated', 'updated_at'],
+                        batch_size=self.flush_every,
+                    )
+                TranslationVersion.objects.bulk_create(
+                    [
+                        book_item_element.build_version(self.user, self.is_machine_translation)
+                        for book_item_element in self.versioned_elements
+                    ],
+                    batch_size=self.flush_every,
+                )
+                update_index(
+                    (book_item_element.book_item_id, book_item_element.element_id)
+                    for book_item_element in chain(self.new_elements, self.updated_elements)
+                )
+                # After the elements, so a render is never older than the rows it was built from
+                for book_item, language, mirror, content_hash, content in self.renders:
+                    BookItemRender.objects.update_or_create(
+                        book_item=book_item,
+                        language=language,
+                        mirror=mirror,
+                        defaults={'content_hash': content_hash, 'content': content},
+                    )
+                self.flush_stats()
+            self.new_elements = []
+            self.updated_elements = []
+            self.versioned_elements = []
+            self.renders = []
+        self.last_flush = time.monotonic()
+
+    def flush_stats(self):
+        if not self.stats:
+            return
+        book_ids = dict(
+            BookItem.objects.filter(pk__in={book_item_id for book_item_id, _ in self.stats}).values_list('id', 'book_id')
+        )
+        changes = defaultdict(Counter)
+        for (book_item_id, language_id), counts in self.stats.items():
+            changes[(book_ids[book_item_id], language_id)].update(counts)
+        for (book_id, language_id), counts in changes.items():
+            BookTranslationStats.apply(book_id, language_id, **counts)
+        self.stats = defaultdict(Counter)
+
+    @staticmethod
+    def load_primary_keys(book_item_elements):
+        # MySQL can't return ids from a bulk insert; fetch them by the unique key instead
+        missing = [book_item_element for book_item_element in book_item_elements if book_item_element.pk is None]
+        if not missing:
+            return
+        ids = {
+            (book_item_id, element_id, language_id): pk
+            for pk, book_item_id, element_id, language_id in BookItemElement.objects.filter(
+                book_item_id__in={book_item_element.book_item_id for book_item_element in missing},
+                language_id__in={book_item_element.language_id for book_item_element in missing},
+                element_id__in={book_item_element.element_id for book_item_element in missing},
+            ).values_list('id', 'book_item_id', 'element_id', 'language_id')
+        }
+        for book_item_element in missing:
+            book_item_element.pk = ids[
+                (book_item_element.book_item_id, book_item_element.element_id, book_item_element.language_id)
+            ]
@@ -1,13 +1,20 @@
-from openai import OpenAI
 import environ
+import json
 import re
 
+from .llm_client import get_async_client, get_client
+from .scheduler import scheduler
+from .segmenter import count_tokens, join_chunks, split_text
+
 env = environ.Env()
 environ.Env.read_env()
 
-API_BASE = env('API_BASE')
-API_KEY = env('API_KEY')
 API_MODEL = env('API_MODEL')
+# Bump whenever the translation prompts change, so translation memory entries
+# produced by older prompts are no longer reused.
+PROMPT_VERSION = '1'
+# Longer texts are split at sentence boundaries and translated in parts
+API_MAX_SEGMENT_TOKENS = env.int('API_MAX_SEGMENT_TOKENS', default=1000)
 
 class ChatGPT:
     def translate(self, text, lang_from, lang_to):
@@ -20,56 +27,247 @@ class ChatGPT:
             print('Text contains only digits and allowed punctuation. Returning original.')
             return text
 
-        client = OpenAI(
-                base_url=API_BASE,
-                api_key=API_KEY,
-                )
+        if count_tokens(text) > API_MAX_SEGMENT_TOKENS:
+            chunks = split_text(text, API_MAX_SEGMENT_TOKENS)
+            print(f'Text is over {API_MAX_SEGMENT_TOKENS} tokens, translating it in {len(chunks)} parts.')
+            t_text = join_chunks(
+                [self.request_translation(chunk, lang_from, lang_to) for chunk, _ in chunks],
+                [separator for _, separator in chunks],
+            )
+        else:
+            t_text = self.request_translation(text, lang_from, lang_to)
+
+        print('Translation:')
+        print(t_text)
+        return t_text
+
+    def request_translation(self, text, lang_from, lang_to):
+        client = get_client()
         language_to = lang_to
         language_from = lang_from
+        prompt = f"Return only a translation.  Keep line breaks.  Translate the following text from {language_from} into {language_to}.\n {language_from}: {text}\n{language_to}:"
         try:
-            completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"Return only a translation.  Keep line breaks.  Translate the following text from {language_from} into {language_to}.\n {language_from}: {text}\n{language_to}:"
-                    }
-                ],
-                model=API_MODEL,
+            completion = scheduler.call(
+                lambda: client.chat.completions.create(
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt
+                        }
+                    ],
+                    model=API_MODEL,
+                ),
+                tokens=count_tokens(prompt) + count_tokens(text),
             )
-            t_text = (
-                completion.choices[0].message.content
-                .encode("utf8")
-                .decode()
+        except Exception as e:
+            # The scheduler has already retried transient failures
+            print(str(e))
+            raise
+        t_text = (
+            completion.choices[0].message.content
+            .encode("utf8")
+            .decode()
+        )
+        return t_text
+
+    def translate_many(self, segments, lang_from, lang_to, max_tokens=None):
+        """Translate a list of segments with a single request.
+
+        The segments are sent as a JSON array and the model is asked to answer
+        with an array of the same length.  If the reply cannot be parsed or the
+        counts don't line up, each segment is translated on its own instead.
+        """
+        translations = [None] * len(segments)
+        pending = []
+        for index, text in enumerate(segments):
+            if not text.strip():
+                translations[index] = ''
+            elif re.match(r'^[\d\s\-\?]*$', text):
+                translations[index] = text
+            elif count_tokens(text) > API_MAX_SEGMENT_TOKENS:
+                translations[index] = self.translate(text, lang_from, lang_to)
+            else:
+                pending.append(index)
+
+        if len(pending) == 1:
+            translations[pending[0]] = self.translate(segments[pending[0]], lang_from, lang_to)
+            return translations
+        if not pending:
+            return translations
+
+        source = [segments[index] for index in pending]
+        print(f'Translating batch of {len(source)} segments:')
+        print(source)
+
+        client = get_client()
+        prompt = (
+            f"Translate each string in the following JSON array from {lang_from} into {lang_to}. "
+            f"Return only a JSON array of {len(source)} translated strings, in the same order. "
+            "Keep line breaks.\n"
+            f"{json.dumps(source, ensure_ascii=False)}"
+        )
+        request = {
+            'messages': [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ],
+            'model': API_MODEL,
+        }
+        if max_tokens:
+            request['max_tokens'] = max_tokens
+
+        result = None
+        try:
+            completion = scheduler.call(
+                lambda: client.chat.completions.create(**request),
+                tokens=count_tokens(prompt) + (max_tokens or count_tokens(''.join(source))),
             )
+            result = self.parse_json_list(completion.choices[0].message.content)
         except Exception as e:
+            # e.g. the batch is too long for the context, or still failing after the
+            # scheduler's retries; single segments may still go through
             print(str(e))
 
-        print('Translation:')
-        print(t_text)
-        return t_text
+        if result is None or len(result) != len(source):
+            print('Batch translation did not line up with the source. Translating segments one by one.')
+            result = [self.translate(text, lang_from, lang_to) for text in source]
+
+        for index, translation in zip(pending, result):
+            translations[index] = translation
+
+        print('Translations:')
+        print(result)
+        return translations
+
+    def translate_languages(self, segments, lang_from, langs_to):
+        """Translate a list of segments into several languages with a single request.
+
+        Returns a list parallel to ``segments`` of {language: translation}.  If
+        the reply cannot be parsed or doesn't cover every segment and language,
+        the segments are translated with translate_many per language instead.
+        """
+        if len(langs_to) == 1:
+            return [{langs_to[0]: translation} for translation in self.translate_many(segments, lang_from, langs_to[0])]
+
+        translations = [None] * len(segments)
+        pending = []
+        for index, text in enumerate(segments):
+            if not text.strip():
+                translations[index] = {lang_to: '' for lang_to in langs_to}
+            elif re.match(r'^[\d\s\-\?]*$', text):
+                translations[index] = {lang_to: text for lang_to in langs_to}
+            elif count_tokens(text) > API_MAX_SEGMENT_TOKENS:
+                translations[index] = {lang_to: self.translate(text, lang_from, lang_to) for lang_to in langs_to}
+            else:
+                pending.append(index)
+        if not pending:
+            return translations
+
+        source = [segments[index] for index in pending]
+        print(f'Translating batch of {len(source)} segments into {", ".join(langs_to)}:')
+        print(source)
+
+        client = get_client()
+        prompt = (
+            f"Translate each string in the following JSON array from {lang_from} "
+            f"into each of these languages: {', '.join(langs_to)}. "
+            f"Return only a JSON array of {len(source)} objects, in the same order, "
+            "each with the language names as keys and the translations as values. "
+            "Keep line breaks.\n"
+            f"{json.dumps(source, ensure_ascii=False)}"
+        )
+
+        result = None
+        try:
+            completion = scheduler.call(
+                lambda: client.chat.completions.create(
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt
+                        }
+                    ],
+                    model=API_MODEL,
+                ),
+                tokens=count_tokens(prompt) + count_tokens(''.join(source)) * len(langs_to),
+            )
+            result = self.parse_json_objects(completion.choices[0].message.content, langs_to)
+        except Exception as e:
+            print(str(e))
+
+        if result is None or len(result) != len(source):
+            print('Multi-language translation did not line up with the source. Translating language by language.')
+            by_language = {lang_to: self.translate_many(source, lang_from, lang_to) for lang_to in langs_to}
+            result = [{lang_to: by_language[lang_to][n] for lang_to in langs_to} for n in range(len(source))]
+
+        for index, translation in zip(pending, result):
+            translations[index] = translation
+
+        print('Translations:')
+        print(result)
+        return translations
+
+    @staticmethod
+    def parse_json_objects(reply, keys):
+        match = re.search(r'\[.*\]', reply.strip(), re.DOTALL)
+        if not match:
+            return None
+        try:
+            result = json.loads(match.group(0))
+        except ValueError:
+            return None
+        if not isinstance(result, list):
+            return None
+        for item in result:
+            if not isinstance(item, dict) or not all(isinstance(item.get(key), str) for key in keys):
+                return None
+        return [{key: item[key] for key in keys} for item in result]
+
+    @staticmethod
+    def parse_json_list(reply):
+        # Models sometimes wrap the array in a markdown code fence
+        reply = reply.strip()
+        match = re.search(r'\[.*\]', reply, re.DOTALL)
+        if not match:
+            return None
+        try:
+            result = json.loads(match.group(0))
+        except ValueError:
+            return None
+        if not isinstance(result, list) or not all(isinstance(item, str) for item in result):
+            return None
+        return result
+
+    @staticmethod
+    def ask_messages(content, question):
+        prompt = f"Here's some content:\n\n{content}\n\nPlease answer the following question based on this content:\n\n{question}"
+        return [
+            {
+                "role": "system",
+                "content": "You are a helpful assistant that answers questions based on the provided content."
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
 
     def ask(self, content, question):
         if not content.strip() or not question.strip():
             return ''
         
-        client = OpenAI(
-            base_url=API_BASE,
-            api_key=API_KEY,
-        )
+        client = get_client()
         
+        messages = self.ask_messages(content, question)
         try:
-            completion = client.chat.completions.create(
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that answers questions based on the provided content."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Here's some content:\n\n{content}\n\nPlease answer the following question based on this content:\n\n{question}"
-                    }
-                ],
-                model=API_MODEL,
+            completion = scheduler.call(
+                lambda: client.chat.completions.create(
+                    messages=messages,
+                    model=API_MODEL,
+                ),
+                tokens=count_tokens(messages[-1]['content']),
             )
             
             answer = (
@@ -87,4 +285,17 @@ class ChatGPT:
             print(f"An error occurred: {str(e)}")
             return f"An error occurred while processing your request: {str(e)}"
 
+    async def ask_stream(self, content, question):
+        """Like ask, but yields the answer in pieces as the model produces them."""
+        if not content.strip() or not question.strip():
+            return
 
+        client = get_async_client()
+        messages = self.ask_messages(content, question)
+        stream = await scheduler.call_async(
+            lambda: client.chat.completions.create(messages=messages, model=API_MODEL, stream=True),
+            tokens=count_tokens(messages[-1]['content']),
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
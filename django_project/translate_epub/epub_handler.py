@@ -0,0 +1,569 @@
+import os
+import posixpath
+import re
+import shutil
+import warnings
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import cached_property
+from urllib.parse import unquote
+
+from bs4 import BeautifulSoup as bs, XMLParsedAsHTMLWarning
+from ebooklib import epub
+from rich import print
+
+from django.db.models import Max
+
+from .models import Book, BookItem, BookItemElement, BookItemRender, Language, hash_content
+from .chatgpt import ChatGPT
+from .bulk_writer import TranslationWriter
+from .targets import TargetLanguage, parse_languages, translate_targets
+from .splice import element_offsets, splice
+from .telemetry import telemetry
+
+DOCUMENT_MEDIA_TYPES = ('application/xhtml+xml', 'text/html')
+# BeautifulSoup tree builders.  html.parser is the default: elements are stored
+# by position and type, so books translated with it only resume with the same
+# parser, and lxml moves a block nested in a <p> out of it, leaving its text
+# untranslated.  lxml is faster; lxml-xml only suits well-formed XHTML.
+PARSERS = ('html.parser', 'lxml', 'lxml-xml')
+ELEMENT_TYPES = ['h1', 'h2', 'h3', 'h4', 'p', 'li']
+
+# Epub documents are XHTML; parsing them with an HTML parser is deliberate
+warnings.filterwarnings('ignore', category=XMLParsedAsHTMLWarning)
+
+
+class TEPUB:
+    """Translates an EPUB into one or more languages.
+
+    ``lang_to`` is a language name or a list of them.  The book is read, and
+    each document parsed and stored, once; the elements are then translated
+    into every language and one output file is written per language, in
+    ``output_dir`` (the current directory by default).
+    """
+
+    def __init__(self, epub_name, lang_from, lang_to, mirror=False, concurrency=1, batch_size=1,
+                 flush_every=200, flush_seconds=10.0, parser='html.parser', batch_tokens=2000, combined_prompt=False,
+                 output_dir=None):
+        self.epub_name = epub_name
+        self.output_dir = output_dir
+        self.origin_book = self.read_book()
+        self.lang_from = lang_from
+        self.targets = [TargetLanguage(lang_from, name) for name in parse_languages(lang_to)]
+        self.combined_prompt = combined_prompt
+        self.mirror = mirror
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.parser = parser
+
+    @cached_property
+    def translate_model(self):
+        # Created on first use, so exporting never sets up an LLM client
+        return ChatGPT()
+
+    def read_book(self):
+        with telemetry.stage('parse'):
+            return epub.read_epub(self.epub_name)
+
+    def translate_texts(self, executor, texts):
+        # Translation memory first; only the misses go to the LLM
+        return translate_targets(
+            self.translate_model, self.lang_from, texts, self.batch_size, self.batch_tokens, executor,
+            self.combined_prompt,
+        )
+
+    def get_item_info(self, item):
+        info = {
+            'id': item.id,
+            'file_name': item.file_name,
+            'media_type': item.media_type,
+            'is_linear': item.is_linear,
+            'manifest': item.manifest,
+            'type': item.get_type(),
+            'is_chapter': False,
+            'heading': None,
+            'subheading': None,
+        }
+        return info
+
+    def parse_document(self, content):
+        return bs(content, self.parser)
+
+    def serialize_document(self, soup):
+        return soup.encode()
+
+    def classify_document(self, info, content, soup):
+        # Check if it might be a chapter
+        is_chapter = False
+        heading = None
+        subheading = None
+        if info['type'] == 9:  # ITEM_DOCUMENT
+            content = content.decode('utf-8')
+            content_lower = content.lower()
+            # print(content)
+
+            # Extract the content of the first h1 tag
+            first_h1 = soup.find('h1')
+            if first_h1:
+                heading = first_h1.get_text(strip=True)
+            first_h2 = soup.find('h2')
+            if first_h2:
+                subheading = first_h2.get_text(strip=True)
+
+            # Check if 'chapter' is in the heading or subheading
+            if (heading and 'chapter' in heading.lower()) or (subheading and 'chapter' in subheading.lower()):
+                is_chapter = True
+            else:
+                # Exclude common non-chapter items
+                excluded_terms = ['table of contents']
+                if any(term in info['file_name'].lower() or term in content_lower for term in excluded_terms):
+                    is_chapter = False
+                elif 'chapter' in info['file_name'].lower() or 'chapter' in info['id'].lower():
+                    is_chapter = True
+                else:
+                    # Check content for chapter indicators
+                    chapter_indicators = [
+                        r'<h\d[^>]*>chapter',  # <h1>Chapter, <h2>Chapter, etc.
+                        r'<h\d[^>]*>\s*\d+',   # <h1>1, <h2>2, etc.
+                        r'class=["\']chapter'  # class="chapter-title", etc.
+                    ]
+                    if any(re.search(pattern, content_lower) for pattern in chapter_indicators):
+                        is_chapter = True
+
+        return {
+            'is_chapter': is_chapter,
+            'heading': heading,
+            'subheading': subheading,
+        }
+
+    def print_item_info(self, item_index, item_info):
+        print(f"Item {item_index}:")
+        for key, value in item_info.items():
+            print(f"  {key}: {value}")
+        print()
+
+    def get_output_name(self, target):
+        name = os.path.splitext(os.path.basename(self.epub_name))[0]
+        if self.mirror:
+            name = f"{name}_{self.lang_from}_to_{target.name}_mirrored.epub"
+        else:
+            name = f"{name}_{self.lang_from}_to_{target.name}.epub"
+        return os.path.join(self.output_dir, name) if self.output_dir else name
+
+    def prepare_book(self):
+        with telemetry.stage('db'):
+            book, created = Book.objects.get_or_create(file_name=os.path.basename(self.epub_name))
+            book_items = {book_item.item_id: book_item for book_item in book.items.defer('content')}
+            for target in self.targets:
+                # Reference rows are looked up once per run rather than once per element
+                target.language, _ = Language.objects.get_or_create(name=target.name)
+
+                # Cached renders and the newest element change of every item, to spot unchanged documents
+                target.renders = {
+                    render.book_item_id: render
+                    for render in BookItemRender.objects.filter(
+                        book_item__book=book, language=target.language, mirror=self.mirror
+                    ).defer('content')
+                }
+                target.elements_updated_at = dict(
+                    BookItemElement.objects.filter(book_item__book=book, language=target.language)
+                    .values('book_item')
+                    .annotate(latest=Max('updated_at'))
+                    .values_list('book_item', 'latest')
+                )
+            return book, book_items
+
+    def render_hash(self, content_hash):
+        # The output also depends on the parser and renderer used to produce it
+        return hash_content(f'{content_hash}:{self.parser}:splice')
+
+    def get_cached_render(self, target, book_item, content_hash):
+        render = target.renders.get(book_item.pk)
+        if render is None or render.content_hash != self.render_hash(content_hash):
+            return None
+        # Translations edited after the render was made invalidate it
+        latest = target.elements_updated_at.get(book_item.pk)
+        if latest and latest > render.updated_at:
+            return None
+        return BookItemRender.objects.values_list('content', flat=True).get(pk=render.pk).encode('utf-8')
+
+    def translate_document(self, book, book_items, item_index, item_info, content, writer, executor):
+        """Translate one document into every target language; returns {target: rendered document}."""
+        content_hash = hash_content(content)
+        book_item = book_items.get(str(item_index))
+
+        rendered = {}
+        if book_item is not None and book_item.content_hash == content_hash:
+            with telemetry.stage('db'):
+                for target in self.targets:
+                    cached = self.get_cached_render(target, book_item, content_hash)
+                    if cached is not None:
+                        rendered[target] = cached
+            if len(rendered) == len(self.targets):
+                item_info.update({
+                    'is_chapter': book_item.is_chapter,
+                    'heading': book_item.heading,
+                    'subheading': book_item.subheading,
+                })
+                self.print_item_info(item_index, item_info)
+                print('Unchanged since the last run, reusing the rendered document.')
+                return rendered
+        targets = [target for target in self.targets if target not in rendered]
+
+        # The document is parsed once; classification, extraction and every language share the tree
+        with telemetry.stage('parse'):
+            soup = self.parse_document(content)
+            item_info.update(self.classify_document(item_info, content, soup))
+            p_list = soup.findAll(ELEMENT_TYPES)
+            offsets = None
+            if book_item is None or book_item.content_hash != content_hash or book_item.element_offsets is None:
+                offsets = self.find_element_offsets(content, p_list)
+        self.print_item_info(item_index, item_info)
+
+        with telemetry.stage('db'):
+            fields = {
+                'item_type': item_info['type'],
+                'content': content,
+                'content_hash': content_hash,
+                'heading': item_info.get('heading', ''),
+                'subheading': item_info.get('subheading', ''),
+                'is_chapter': item_info.get('is_chapter', False),
+                'element_offsets': offsets,
+            }
+            if book_item is None:
+                # Another run or queue job on the book (e.g. for another language) may have
+                # stored the item since book_items was loaded
+                book_item, _ = BookItem.objects.get_or_create(book=book, item_id=item_index, defaults=fields)
+                book_items[str(item_index)] = book_item
+
+            if book_item.content_hash != content_hash:
+                for name, value in fields.items():
+                    setattr(book_item, name, value)
+                book_item.save()
+            elif offsets is not None and book_item.element_offsets is None:
+                # Stored before element offsets were recorded
+                book_item.element_offsets = offsets
+                book_item.save(update_fields=['element_offsets'])
+
+            # Load every stored element of this item in the target languages in one query
+            existing_elements = {target: {} for target in targets}
+            languages = {target.language.pk: target for target in targets}
+            for book_item_element in BookItemElement.objects.filter(book_item=book_item, language__in=languages):
+                existing_elements[languages[book_item_element.language_id]][book_item_element.element_id] = (
+                    book_item_element
+                )
+
+        elements = [
+            (element_index, p, hash_content(p.text))
+            for element_index, p in enumerate(p_list)
+            if p.text and not p.text.isdigit()
+        ]
+        pending = {}
+        for target in targets:
+            pending[target] = []
+            for element_index, p, source_hash in elements:
+                book_item_element = existing_elements[target].get(element_index)
+                # Stored rows are unique per element_id, so a retagged element (e.g. p to h2)
+                # updates its row and is translated again
+                changed = book_item_element is not None and (
+                    book_item_element.element_type != p.name or not book_item_element.has_source(p.text, source_hash)
+                )
+                pending[target].append((element_index, p, source_hash, book_item_element, changed))
+            telemetry.count_elements(len(pending[target]))
+
+        # Only new elements and elements whose source text changed go to the LLM
+        translations = self.translate_texts(executor, {
+            target: [p.text for _, p, _, book_item_element, changed in pending[target] if book_item_element is None or changed]
+            for target in targets
+        })
+
+        # Rendering the output; buffered DB writes count as db
+        with telemetry.stage('serialize'):
+            for n, target in enumerate(targets):
+                target_translations = iter(translations[target])
+                rendered_translations = {}
+                for element_index, p, source_hash, book_item_element, changed in pending[target]:
+                    if book_item_element and not changed:
+                        # Already stored; nothing to write back
+                        translation = book_item_element.translated_content
+                    elif book_item_element:
+                        translation = next(target_translations)
+                        book_item_element.element_type = p.name
+                        book_item_element.content = p.text
+                        book_item_element.source_hash = source_hash
+                        writer.update(book_item_element, translation, source_changed=True)
+                    else:
+                        # If the element doesn't exist, queue it and its TranslationVersion for saving
+                        translation = next(target_translations)
+                        writer.add(BookItemElement(
+                            book_item=book_item,
+                            element_id=element_index,
+                            element_type=p.name,
+                            content=p.text,
+                            source_hash=source_hash,
+                            translated_content=translation,
+                            language=target.language,
+                            complete=False
+                        ))
+
+                    rendered_translations[element_index] = translation
+
+                # The parsed tree can only be rendered into once; it is given to the last language
+                rendered[target] = self.render_document(
+                    content, soup if n == len(targets) - 1 else None, p_list, book_item.element_offsets,
+                    rendered_translations,
+                )
+                writer.add_render(
+                    book_item, target.language, self.mirror, self.render_hash(content_hash),
+                    rendered[target].decode('utf-8'),
+                )
+        return rendered
+
+    def find_element_offsets(self, content, p_list):
+        try:
+            offsets = element_offsets(content.decode('utf-8'), p_list)
+        except UnicodeDecodeError:
+            offsets = None
+        # An empty list records that the document can't be spliced
+        return offsets if offsets is not None else []
+
+    def render_document(self, content, soup, p_list, offsets, translations):
+        """Output document with ``translations`` ({element index: text}) in place of the originals.
+
+        With recorded offsets the translations are spliced into the source in
+        one pass and all other markup stays byte for byte as it was; otherwise
+        the parsed tree is rewritten and serialized.  Pass ``soup`` None to
+        render into a fresh parse, leaving the shared tree untouched.
+        """
+        if offsets and len(offsets) == len(p_list):
+            return splice(content.decode('utf-8'), offsets, translations, self.mirror).encode('utf-8')
+        if soup is None:
+            with telemetry.stage('parse'):
+                soup = self.parse_document(content)
+                p_list = soup.findAll(ELEMENT_TYPES)
+        for element_index, translation in translations.items():
+            self.render_translation(soup, p_list[element_index], translation)
+        return self.serialize_document(soup)
+
+    def render_translation(self, soup, p, translation):
+        # Split translation into lines and create HTML with <br> for line breaks
+        translation_lines = translation.split('\n')
+        new_p_contents = soup.new_tag("span")  # Using span to insert HTML content inside p tag
+        for line in translation_lines:
+            if new_p_contents.contents:  # If not the first line, add a <br> before adding next line
+                new_p_contents.append(soup.new_tag("br"))
+            new_p_contents.append(soup.new_string(line))
+
+        new_p = soup.new_tag("p")
+        new_p.insert(0, new_p_contents)
+
+        if self.mirror:
+            p.insert_after(new_p)
+        else:
+            p.replace_with(new_p)
+
+    def translate_book(self):
+        book, book_items = self.prepare_book()
+
+        new_book = epub.EpubBook()
+        new_book.metadata = self.origin_book.metadata
+        new_book.spine = self.origin_book.spine
+        new_book.toc = self.origin_book.toc
+
+        # Only the LLM calls run on the pool; all database work stays on this
+        # thread and results are applied in document order.
+        documents = {target: {} for target in self.targets}
+        with TranslationWriter(self.flush_every, self.flush_seconds) as writer, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for item_index, i in enumerate(self.origin_book.get_items()):
+
+                item_info = self.get_item_info(i)
+
+                if i.get_type() == 9:
+                    rendered = self.translate_document(
+                        book, book_items, item_index, item_info, i.content, writer, executor
+                    )
+                    for target, content in rendered.items():
+                        documents[target][i] = content
+                else:
+                    self.print_item_info(item_index, item_info)
+
+                new_book.add_item(i)
+
+        # The items are shared; each language's documents are put in place before its book is written
+        with telemetry.stage('serialize'):
+            for target in self.targets:
+                for i, content in documents[target].items():
+                    i.content = content
+                epub.write_epub(self.get_output_name(target), new_book, {})
+
+
+class StreamingTEPUB(TEPUB):
+    """Translates an EPUB one zip entry at a time.
+
+    Nothing is loaded up front: documents listed in the OPF manifest are read,
+    translated and written to the output zip one by one, and every other entry
+    (images, fonts, styles, the package files themselves) is copied straight
+    through.  Peak memory is bounded by the largest single document.
+
+    Items are numbered by their position in the OPF manifest, which is the
+    order ebooklib reads them in, so stored translations are shared with the
+    non-streaming mode.
+    """
+
+    def read_book(self):
+        return None
+
+    @staticmethod
+    def read_manifest(zip_ref):
+        container = ET.fromstring(zip_ref.read('META-INF/container.xml'))
+        rootfile = container.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')
+        opf_path = rootfile.attrib['full-path']
+        opf_dir = posixpath.dirname(opf_path)
+
+        namespace = {'opf': 'http://www.idpf.org/2007/opf'}
+        package = ET.fromstring(zip_ref.read(opf_path))
+        spine = package.find('opf:spine', namespace)
+        linear = {
+            itemref.attrib.get('idref'): itemref.attrib.get('linear', 'yes') != 'no'
+            for itemref in (spine if spine is not None else [])
+        }
+
+        documents = {}
+        for item_index, item in enumerate(package.find('opf:manifest', namespace)):
+            media_type = item.attrib.get('media-type')
+            if media_type not in DOCUMENT_MEDIA_TYPES:
+                continue
+            file_name = unquote(item.attrib['href'])
+            documents[posixpath.normpath(posixpath.join(opf_dir, file_name))] = (item_index, {
+                'id': item.attrib.get('id'),
+                'file_name': file_name,
+                'media_type': media_type,
+                'is_linear': linear.get(item.attrib.get('id'), True),
+                'manifest': True,
+                'type': 9,
+                'is_chapter': False,
+                'heading': None,
+                'subheading': None,
+            })
+        return documents
+
+    @staticmethod
+    def copy_zipinfo(info):
+        new_info = zipfile.ZipInfo(info.filename, info.date_time)
+        new_info.compress_type = info.compress_type
+        new_info.external_attr = info.external_attr
+        new_info.create_system = info.create_system
+        new_info.file_size = info.file_size
+        return new_info
+
+    def translate_book(self):
+        book, book_items = self.prepare_book()
+
+        with ExitStack() as stack:
+            input_zip = stack.enter_context(zipfile.ZipFile(self.epub_name, 'r'))
+            # One output per language, all written in the same pass over the input
+            output_zips = {
+                target: stack.enter_context(zipfile.ZipFile(self.get_output_name(target), 'w'))
+                for target in self.targets
+            }
+            writer = stack.enter_context(TranslationWriter(self.flush_every, self.flush_seconds))
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.concurrency))
+            documents = self.read_manifest(input_zip)
+
+            # Entries are written in their original order so 'mimetype' stays first and uncompressed
+            for info in input_zip.infolist():
+                output_info = self.copy_zipinfo(info)
+                if info.filename in documents:
+                    item_index, item_info = documents[info.filename]
+                    content = input_zip.read(info)
+                    rendered = self.translate_document(
+                        book, book_items, item_index, item_info, content, writer, executor
+                    )
+                    for target, output_zip in output_zips.items():
+                        output_zip.writestr(output_info, rendered[target])
+                else:
+                    for output_zip in output_zips.values():
+                        with telemetry.stage('serialize'), \
+                                input_zip.open(info) as source, output_zip.open(output_info, 'w') as output:
+                            shutil.copyfileobj(source, output)
+
+
+class ExportTEPUB(StreamingTEPUB):
+    """Rebuilds the translated epub from stored translations without calling the LLM.
+
+    Documents whose cached render is still current are written as they are;
+    the others are rendered again from their stored elements.  Elements with
+    no stored translation for the current source text are left untranslated.
+    """
+
+    def prepare_book(self):
+        if not Book.objects.filter(file_name=os.path.basename(self.epub_name)).exists():
+            raise Exception(f'{os.path.basename(self.epub_name)} has not been translated yet')
+        return super().prepare_book()
+
+    def translate_document(self, book, book_items, item_index, item_info, content, writer, executor):
+        content_hash = hash_content(content)
+        book_item = book_items.get(str(item_index))
+        if book_item is None:
+            print(f"Item {item_index} ({item_info['file_name']}) has not been translated; copied unchanged.")
+            return {target: content for target in self.targets}
+
+        rendered = {}
+        if book_item.content_hash == content_hash:
+            with telemetry.stage('db'):
+                for target in self.targets:
+                    cached = self.get_cached_render(target, book_item, content_hash)
+                    if cached is not None:
+                        rendered[target] = cached
+            if len(rendered) == len(self.targets):
+                return rendered
+        else:
+            print(f"Item {item_index} ({item_info['file_name']}) changed since it was translated; "
+                  f"new text is left untranslated.")
+
+        print(f"Rendering item {item_index} ({item_info['file_name']}) from stored translations.")
+        with telemetry.stage('parse'):
+            soup = self.parse_document(content)
+            p_list = soup.findAll(ELEMENT_TYPES)
+        # Offsets recorded for a different version of the document don't apply
+        offsets = book_item.element_offsets if book_item.content_hash == content_hash else None
+
+        for n, target in enumerate(self.targets):
+            if target in rendered:
+                continue
+            with telemetry.stage('db'):
+                stored_elements = {
+                    book_item_element.element_id: book_item_element
+                    for book_item_element in BookItemElement.objects.filter(
+                        book_item=book_item, language=target.language
+                    )
+                }
+
+            translations = {}
+            for element_index, p in enumerate(p_list):
+                book_item_element = stored_elements.get(element_index)
+                if book_item_element is None or not p.text or p.text.isdigit():
+                    continue
+                if book_item_element.element_type != p.name:
+                    continue
+                if not book_item_element.has_source(p.text, hash_content(p.text)):
+                    continue
+                translations[element_index] = book_item_element.translated_content
+
+            with telemetry.stage('serialize'):
+                rendered[target] = self.render_document(
+                    content, soup if n == len(self.targets) - 1 else None, p_list, offsets, translations
+                )
+
+            if book_item.content_hash == content_hash:
+                writer.add_render(
+                    book_item, target.language, self.mirror, self.render_hash(content_hash),
+                    rendered[target].decode('utf-8'),
+                )
+        return rendered
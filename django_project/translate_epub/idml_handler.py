@@ -1,31 +1,136 @@
+import shutil
 import zipfile
 import xml.etree.ElementTree as ET
+import xml.sax
+from xml.sax.saxutils import XMLGenerator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.db import connections
+
 from .models import Book, BookItem, BookItemElement, Language
 from .chatgpt import ChatGPT
+from .bulk_writer import TranslationWriter
+from .targets import TargetLanguage, parse_languages, translate_targets
+from .scheduler import scheduler
+from .telemetry import telemetry
 
 import logging
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+
+def init_story_worker(workers):
+    # Under the spawn start method the worker starts with a fresh interpreter
+    if not apps.ready:
+        django.setup()
+    # Every worker gets an equal share of the rate limits
+    scheduler.scale(1 / workers)
+
+
+def parse_story_worker(file_path, lang_from, lang_to, options, book_id, file_name):
+    # Counters are sent back per story, so they must not carry over between tasks
+    telemetry.reset()
+    idml_parser = IDMLParser(file_path, lang_from, lang_to, **options)
+    book = Book.objects.get(pk=book_id)
+    for target in idml_parser.targets:
+        target.language = Language.objects.get(name=target.name)
+    # Each worker opens the zip itself; nothing but names and ids crosses the process boundary
+    with zipfile.ZipFile(file_path, 'r') as zip_ref, \
+            TranslationWriter(idml_parser.flush_every, idml_parser.flush_seconds) as idml_parser.writer:
+        if idml_parser.stream:
+            idml_parser.parse_story_stream(book, file_name, zip_ref)
+        else:
+            idml_parser.parse_story(book, file_name, zip_ref.read(file_name))
+    memory = [(target.memory.hits, target.memory.misses) for target in idml_parser.targets]
+    return memory, telemetry.snapshot()
+
+
 class IDMLParser:
-    def __init__(self, file_path, lang_from, lang_to):
+    """Stores the stories of an IDML file and translates them into one or more languages.
+
+    ``lang_to`` is a language name or a list of them; every story is read once
+    and its Content elements are translated into each language.
+    """
+
+    def __init__(self, file_path, lang_from, lang_to, batch_size=1, flush_every=200, flush_seconds=10.0,
+                 batch_tokens=2000, workers=1, stream=False, combined_prompt=False):
         self.file_path = file_path
         self.lang_from = lang_from
-        self.lang_to = lang_to
+        self.targets = [TargetLanguage(lang_from, name) for name in parse_languages(lang_to)]
+        self.combined_prompt = combined_prompt
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.workers = workers
+        self.stream = stream
         self.namespace = {'idPkg': 'http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging'}
         self.translate_model = ChatGPT()
+        self.pending = {}
+        self.existing_elements = {}
+        self.writer = None
 
     def parse(self):
         with zipfile.ZipFile(self.file_path, 'r') as zip_ref:
             book, _ = Book.objects.get_or_create(file_name=self.file_path)
-            
-            for file_name in zip_ref.namelist():
-                if file_name.startswith('Stories/Story_') and file_name.endswith('.xml'):
-                    story_content = zip_ref.read(file_name)
-                    self.parse_story(book, file_name, story_content)
+            for target in self.targets:
+                target.language = Language.objects.get(name=target.name)
+
+            if self.workers > 1:
+                story_names = [
+                    file_name for file_name in zip_ref.namelist()
+                    if file_name.startswith('Stories/Story_') and file_name.endswith('.xml')
+                ]
+                self.parse_parallel(book, story_names)
+                return
+
+            with TranslationWriter(self.flush_every, self.flush_seconds) as self.writer:
+                for file_name in zip_ref.namelist():
+                    if file_name.startswith('Stories/Story_') and file_name.endswith('.xml'):
+                        if self.stream:
+                            self.parse_story_stream(book, file_name, zip_ref)
+                        else:
+                            story_content = zip_ref.read(file_name)
+                            self.parse_story(book, file_name, story_content)
+
+    def parse_parallel(self, book, story_names):
+        """Translate stories in worker processes; returns once every story is stored."""
+        options = {
+            'batch_size': self.batch_size,
+            'flush_every': self.flush_every,
+            'flush_seconds': self.flush_seconds,
+            'batch_tokens': self.batch_tokens,
+            'stream': self.stream,
+            'combined_prompt': self.combined_prompt,
+        }
+        # Forked workers must not share this process's database connections
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_story_worker, initargs=(self.workers,)
+        ) as executor:
+            futures = {
+                executor.submit(
+                    parse_story_worker, self.file_path, self.lang_from, [target.name for target in self.targets],
+                    options, book.pk, file_name,
+                ): file_name
+                for file_name in story_names
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                memory, snapshot = future.result()
+                telemetry.merge(snapshot)
+                for target, (hits, misses) in zip(self.targets, memory):
+                    target.memory.hits += hits
+                    target.memory.misses += misses
+                print(f"[{done}/{len(futures)}] Translated {futures[future]}")
 
     def parse_story(self, book, story_file_name, story_content):
+        with telemetry.stage('parse'):
+            self.parse_story_tree(book, story_file_name, story_content)
+
+    def parse_story_tree(self, book, story_file_name, story_content):
         root = ET.fromstring(story_content)
         story_element = root.find('Story', self.namespace)
         
@@ -36,46 +141,217 @@ class IDMLParser:
         if story_id is None:
             raise ValueError(f"Story element does not have a 'Self' attribute in {story_file_name}")
         
-        book_item, _ = BookItem.objects.get_or_create(
-            book=book,
-            item_id=story_id,
-            defaults={'content': story_content.decode('utf-8'), 'item_type': 9}  # 9 for IDML story
-        )
+        with telemetry.stage('db'):
+            book_item, _ = BookItem.objects.get_or_create(
+                book=book,
+                item_id=story_id,
+                defaults={'content': story_content.decode('utf-8'), 'item_type': 9}  # 9 for IDML story
+            )
 
+        self.load_story_elements(book_item)
         self.process_element(story_element, book_item)
+        self.translate_pending()
+
+    def parse_story_stream(self, book, story_file_name, zip_ref):
+        """Like parse_story, but reads the story with iterparse instead of building the tree.
+
+        Finished elements are dropped as soon as their end tag is seen, so memory
+        stays flat and deeply nested style ranges can't hit the recursion limit.
+        A story seen for the first time is still read whole once, as its source
+        is stored in BookItem.content.
+        """
+        with telemetry.stage('parse'):
+            self.parse_story_events(book, story_file_name, zip_ref)
+
+    def parse_story_events(self, book, story_file_name, zip_ref):
+        book_item = None
+        in_story = False
+        element_counter = 0
+        open_elements = []
+        with zip_ref.open(story_file_name) as stream:
+            for event, element in ET.iterparse(stream, events=('start', 'end')):
+                if event == 'start':
+                    if book_item is None and element.tag == 'Story' and len(open_elements) == 1:
+                        story_id = element.attrib.get('Self')
+                        if story_id is None:
+                            raise ValueError(f"Story element does not have a 'Self' attribute in {story_file_name}")
+                        with telemetry.stage('db'):
+                            book_item = BookItem.objects.filter(book=book, item_id=story_id).first()
+                            if book_item is None:
+                                # Only a new story needs its source stored
+                                book_item = BookItem.objects.create(
+                                    book=book,
+                                    item_id=story_id,
+                                    content=zip_ref.read(story_file_name).decode('utf-8'),
+                                    item_type=9,  # 9 for IDML story
+                                )
+                        self.load_story_elements(book_item)
+                        in_story = True
+                    open_elements.append(element)
+                    continue
+
+                open_elements.pop()
+                if in_story and element.tag.endswith('Content'):
+                    element_counter += 1
+                    self.add_content(book_item, element_counter, element.text if element.text is not None else "")
+                    if sum(len(pending) for pending in self.pending.values()) >= self.flush_every:
+                        self.translate_pending()
+                elif in_story and element.tag == 'Story' and len(open_elements) == 1:
+                    in_story = False
+                if open_elements:
+                    open_elements[-1].remove(element)
+
+        if book_item is None:
+            raise ValueError(f"Could not find Story element in {story_file_name}")
+        self.translate_pending()
+
+    def load_story_elements(self, book_item):
+        self.pending = {target: [] for target in self.targets}
+        self.existing_elements = {target: {} for target in self.targets}
+        languages = {target.language.pk: target for target in self.targets}
+        # One query for every stored element of the story, in all languages, instead of one per Content node
+        with telemetry.stage('db'):
+            for book_item_element in BookItemElement.objects.filter(book_item=book_item, language__in=languages):
+                target = languages[book_item_element.language_id]
+                self.existing_elements[target][book_item_element.element_id] = book_item_element
+
+    def save_translation(self, book_item_element, translation):
+        if book_item_element.pk is None:
+            book_item_element.translated_content = translation
+            self.writer.add(book_item_element)
+        else:
+            self.writer.update(book_item_element, translation)
+
+    def translate_pending(self):
+        # Translation memory first; only the misses go to the LLM
+        translations = translate_targets(
+            self.translate_model,
+            self.lang_from,
+            {target: [book_item_element.content for book_item_element in pending]
+             for target, pending in self.pending.items()},
+            self.batch_size,
+            self.batch_tokens,
+            combined=self.combined_prompt,
+        )
+        for target, pending in self.pending.items():
+            for book_item_element, translation in zip(pending, translations[target]):
+                self.save_translation(book_item_element, translation)
+        self.pending = {target: [] for target in self.targets}
+
+    def add_content(self, book_item, element_counter, content):
+        telemetry.count_elements(len(self.targets))
+        for target in self.targets:
+            book_item_element = self.existing_elements[target].get(element_counter)
+            if book_item_element is None:
+                # Saved together with its translation by the writer
+                book_item_element = BookItemElement(
+                    book_item=book_item,
+                    element_id=element_counter,
+                    language=target.language,
+                    content=content,
+                )
+
+            if book_item_element.pk is None or not book_item_element.translated_content:
+                self.pending[target].append(book_item_element)
 
     def process_element(self, element, book_item, element_counter=0):
         element_counter = int(element_counter)
         if element.tag.endswith('Content'):
             content = element.text if element.text is not None else ""
             element_counter += 1
-            book_item_element, created = BookItemElement.objects.get_or_create(
-                book_item=book_item,
-                element_id=str(element_counter),
-                language=Language.objects.get(name=self.lang_to),
-                defaults={'content': content}
-            )
-            
-            if created or not book_item_element.translated_content:
-                translation = self.translate_model.translate(content, self.lang_from, self.lang_to)
-                book_item_element.save_translation(translation, is_machine_translation=True)
+            self.add_content(book_item, element_counter, content)
         for child in element:
             element_counter = self.process_element(child, book_item, element_counter)
         return element_counter
 
+class StoryContentHandler(XMLGenerator):
+    """SAX handler that copies a story to ``out``, swapping in translated Content text."""
+
+    def __init__(self, out, idml_writer):
+        super().__init__(out, encoding='utf-8', short_empty_elements=True)
+        self.idml_writer = idml_writer
+        self.depth = 0
+        self.story_depth = None
+        self.story_id = None
+        self.replacing = False
+
+    def startElement(self, name, attrs):
+        self.replacing = False
+        self.depth += 1
+        if self.story_depth is None and name == 'Story' and self.depth == 2:
+            self.story_depth = self.depth
+            story_id = attrs.get('Self')
+            logger.debug(f"Processing story with ID: {story_id}")
+            if story_id in self.idml_writer.story_ids:
+                self.story_id = story_id
+                self.idml_writer.element_counter = 0
+            else:
+                logger.error(f"BookItem not found for story ID: {story_id}")
+        super().startElement(name, attrs)
+        if self.story_id is not None and name.endswith('Content'):
+            self.idml_writer.element_counter += 1
+            translation = self.idml_writer.translations.get((self.story_id, self.idml_writer.element_counter))
+            if translation is not None:
+                super().characters(translation)
+                # Drop the original text up to the next tag
+                self.replacing = True
+            else:
+                logger.warning(f"Translation not found for element {self.idml_writer.element_counter} "
+                               f"in language {self.idml_writer.lang_to}")
+
+    def endElement(self, name):
+        self.replacing = False
+        if self.depth == self.story_depth:
+            self.story_id = None
+        self.depth -= 1
+        super().endElement(name)
+
+    def characters(self, content):
+        if not self.replacing:
+            super().characters(content)
+
+    def processingInstruction(self, target, data):
+        # The translation covers all of the Content's text, so keep dropping it past the PI
+        super().processingInstruction(target, data)
+
+
 class IDMLWriter:
-    def __init__(self, input_file, output_path, lang_to):
+    def __init__(self, input_file, output_path, lang_to, stream=False):
         self.input_file = input_file
         self.output_path = output_path
         self.lang_to = lang_to
+        self.stream = stream
         self.namespace = {'idPkg': 'http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging'}
         self.element_counter = 0
+        self.book = None
+        self.story_ids = set()
+        self.translations = {}
+
+    def load_translations(self):
+        """Load every translation of the book in the target language with one query."""
+        try:
+            self.book = Book.objects.get(file_name=self.input_file)
+        except Book.DoesNotExist:
+            logger.error(f"Book not found for file: {self.input_file}")
+            return
+        self.story_ids = set(self.book.items.values_list('item_id', flat=True))
+        self.translations = {
+            (item_id, element_id): translated_content
+            for item_id, element_id, translated_content in BookItemElement.objects.filter(
+                book_item__book=self.book,
+                language__name=self.lang_to,
+            ).values_list('book_item__item_id', 'element_id', 'translated_content')
+        }
 
     def write(self):
-        with zipfile.ZipFile(self.input_file, 'r') as input_zip:
+        with telemetry.stage('db'):
+            self.load_translations()
+        with telemetry.stage('serialize'), zipfile.ZipFile(self.input_file, 'r') as input_zip:
             with zipfile.ZipFile(self.output_path, 'w') as output_zip:
                 for item in input_zip.infolist():
-                    if item.filename.startswith('Stories/Story_') and item.filename.endswith('.xml'):
+                    if self.stream:
+                        self.write_entry_stream(input_zip, output_zip, item)
+                    elif item.filename.startswith('Stories/Story_') and item.filename.endswith('.xml'):
                         story_content = input_zip.read(item.filename)
                         modified_content = self.modify_story_content(story_content)
                         output_zip.writestr(item.filename, modified_content)
@@ -83,38 +359,42 @@ class IDMLWriter:
                         buffer = input_zip.read(item.filename)
                         output_zip.writestr(item.filename, buffer)
 
+    def write_entry_stream(self, input_zip, output_zip, item):
+        """Copy one zip entry without holding it in memory, translating it if it is a story."""
+        with input_zip.open(item) as source, output_zip.open(item.filename, 'w') as target:
+            if item.filename.startswith('Stories/Story_') and item.filename.endswith('.xml'):
+                if self.book is None:
+                    shutil.copyfileobj(source, target)
+                    return
+                parser = xml.sax.make_parser()
+                parser.setContentHandler(StoryContentHandler(target, self))
+                parser.parse(source)
+            else:
+                shutil.copyfileobj(source, target)
+
     def modify_story_content(self, story_content):
         root = ET.fromstring(story_content)
         story_element = root.find('Story', self.namespace)
-        if story_element is not None:
+        if story_element is not None and self.book is not None:
             story_id = story_element.attrib.get('Self')
             logger.debug(f"Processing story with ID: {story_id}")
-            try:
-                book = Book.objects.get(file_name=self.input_file)
-                book_item = BookItem.objects.get(book=book, item_id=story_id)
+            if story_id in self.story_ids:
                 self.element_counter = 0
-                self.process_element(story_element, book_item)
-            except Book.DoesNotExist:
-                logger.error(f"Book not found for file: {self.input_file}")
-            except BookItem.DoesNotExist:
+                self.process_element(story_element, story_id)
+            else:
                 logger.error(f"BookItem not found for story ID: {story_id}")
 
         return ET.tostring(root, encoding='utf-8', xml_declaration=True)
 
-    def process_element(self, element, book_item):
+    def process_element(self, element, story_id):
         if element.tag.endswith('Content'):
             self.element_counter += 1
-            try:
-                book_item_element = BookItemElement.objects.get(
-                    book_item=book_item,
-                    element_id=str(self.element_counter),
-                )
-                element.text = book_item_element.translated_content
+            translation = self.translations.get((story_id, self.element_counter))
+            if translation is not None:
+                element.text = translation
                 # logger.debug(f"Found translation for element {self.element_counter}: {element.text[:50]}...")
-            except BookItemElement.DoesNotExist:
+            else:
                 logger.warning(f"Translation not found for element {self.element_counter} in language {self.lang_to}")
 
         for child in element:
-            self.process_element(child, book_item)
-
-
+            self.process_element(child, story_id)
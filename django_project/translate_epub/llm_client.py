@@ -0,0 +1,111 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import environ
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+env = environ.Env()
+environ.Env.read_env()
+
+API_BASE = env('API_BASE')
+API_KEY = env('API_KEY')
+API_POOL_SIZE = env.int('API_POOL_SIZE', default=32)
+API_TIMEOUT = env.float('API_TIMEOUT', default=600.0)
+API_CONNECT_TIMEOUT = env.float('API_CONNECT_TIMEOUT', default=10.0)
+API_KEEPALIVE_EXPIRY = env.float('API_KEEPALIVE_EXPIRY', default=30.0)
+API_HTTP2 = env.bool('API_HTTP2', default=False)
+
+
+class ClientManager:
+    """Hands out long-lived OpenAI clients that share a keep-alive connection pool.
+
+    There is one sync client per process and one async client per event loop,
+    because httpx async connections can't be shared between loops.
+    """
+
+    def __init__(self, base_url=API_BASE, api_key=API_KEY, pool_size=API_POOL_SIZE, timeout=API_TIMEOUT,
+                 connect_timeout=API_CONNECT_TIMEOUT, keepalive_expiry=API_KEEPALIVE_EXPIRY, http2=API_HTTP2):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _http_options(self):
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                raise Exception('API_HTTP2 is enabled but the h2 package is not installed (pip install httpx[http2])')
+        return {
+            'limits': httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            'timeout': httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            'http2': self.http2,
+        }
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = OpenAI(
+                        base_url=self.base_url,
+                        api_key=self.api_key,
+                        # Retries are handled by scheduler.RequestScheduler
+                        max_retries=0,
+                        http_client=httpx.Client(**self._http_options()),
+                    )
+        return self._client
+
+    def get_async_client(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = AsyncOpenAI(
+                    base_url=self.base_url,
+                    api_key=self.api_key,
+                    # Retries are handled by scheduler.RequestScheduler.call_async
+                    max_retries=0,
+                    http_client=httpx.AsyncClient(**self._http_options()),
+                )
+                self._async_clients[loop] = client
+        return client
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            self._async_clients = weakref.WeakKeyDictionary()
+
+    def reset(self):
+        # Connections inherited over fork() belong to the parent; just forget them.
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+
+
+client_manager = ClientManager()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=client_manager.reset)
+
+
+def get_client():
+    return client_manager.get_client()
+
+
+def get_async_client():
+    return client_manager.get_async_client()
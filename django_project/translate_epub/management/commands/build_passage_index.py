@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from translate_epub.models import BookItem
+from translate_epub.passage_index import index_item
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the passage index that ask_question retrieves from'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--book_name',
+            dest='book_name',
+            type=str,
+            help='only index this book (its file name as stored); all books by default',
+        )
+
+    def handle(self, *args, **options):
+        book_items = BookItem.objects.all()
+        if options['book_name']:
+            book_items = book_items.filter(book__file_name=options['book_name'])
+
+        count = 0
+        for book_item_id in book_items.values_list('id', flat=True).iterator():
+            index_item(book_item_id)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} items.'))
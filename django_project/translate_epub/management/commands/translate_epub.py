@@ -1,9 +1,5 @@
 from openai import OpenAI
 import environ
-import re
-from bs4 import BeautifulSoup as bs
-from ebooklib import epub
-from rich import print
 import os
 from django.db import transaction
 import zipfile
@@ -15,6 +11,10 @@ from django.db.models import Q
 from translate_epub.models import Book, BookItem, BookItemElement, Language
 from translate_epub.chatgpt import ChatGPT
 from translate_epub.idml_handler import IDMLParser, IDMLWriter
+from translate_epub.epub_handler import TEPUB, ExportTEPUB, StreamingTEPUB, PARSERS
+from translate_epub.work_queue import enqueue
+from translate_epub.targets import parse_languages
+from translate_epub.telemetry import telemetry
 
 
 env = environ.Env()
@@ -32,7 +32,7 @@ class Command(BaseCommand):
             '--lang_to',
             dest='lang_to',
             type=str,
-            help='translate the epub to language',
+            help='translate the epub to language; several languages separated by commas get one output each',
         )
         parser.add_argument(
             '--lang_from',
@@ -51,6 +51,87 @@ class Command(BaseCommand):
             action='store_true',
             help='keep both original and translated paragraphs',
         )
+        parser.add_argument(
+            '--concurrency',
+            dest='concurrency',
+            type=int,
+            default=1,
+            help='number of translation requests to send in parallel',
+        )
+        parser.add_argument(
+            '--batch_size',
+            dest='batch_size',
+            type=int,
+            default=1,
+            help='number of elements to translate in a single request',
+        )
+        parser.add_argument(
+            '--batch_tokens',
+            dest='batch_tokens',
+            type=int,
+            default=2000,
+            help='token budget for the source text of a single batched request',
+        )
+        parser.add_argument(
+            '--flush_every',
+            dest='flush_every',
+            type=int,
+            default=200,
+            help='write buffered translations to the database every N elements',
+        )
+        parser.add_argument(
+            '--flush_seconds',
+            dest='flush_seconds',
+            type=float,
+            default=10.0,
+            help='write buffered translations to the database at least every N seconds',
+        )
+        parser.add_argument(
+            '--workers',
+            dest='workers',
+            type=int,
+            default=1,
+            help='number of processes translating idml stories in parallel',
+        )
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='read and write the book one zip entry at a time to keep memory bounded; idml stories are parsed incrementally',
+        )
+        parser.add_argument(
+            '--parser',
+            dest='parser',
+            choices=PARSERS,
+            default='html.parser',
+            help='BeautifulSoup parser used for epub documents; keep the one a book was first translated with',
+        )
+        parser.add_argument(
+            '--combined_prompt',
+            action='store_true',
+            help='with several --lang_to languages, ask for all of them in one request per segment batch',
+        )
+        parser.add_argument(
+            '--enqueue',
+            action='store_true',
+            help='queue the book for translate_worker processes instead of translating it here',
+        )
+        parser.add_argument(
+            '--export_only',
+            action='store_true',
+            help='rebuild the translated file from the database without translating anything',
+        )
+        parser.add_argument(
+            '--metrics_json',
+            dest='metrics_json',
+            type=str,
+            help='write stage timings, LLM latency and token counts of the run to this JSON file',
+        )
+        parser.add_argument(
+            '--metrics_prom',
+            dest='metrics_prom',
+            type=str,
+            help='write the same metrics in Prometheus text format (e.g. for the node_exporter textfile collector)',
+        )
         parser.add_argument('--debug', action='store_true', help='print debug information')
 
     def handle(self, *args, **options):
@@ -58,32 +139,135 @@ class Command(BaseCommand):
             raise Exception('This program translates .epub and .idml files only.')
         if not options['lang_to'] or not options['lang_from']:
             raise Exception('needs --lang_to and --lang_from')
+        options['lang_to'] = parse_languages(options['lang_to'])
+        if not options['lang_to']:
+            raise Exception('--lang_to names no language')
+        if options['concurrency'] < 1:
+            raise Exception('--concurrency must be at least 1')
+        if options['batch_size'] < 1:
+            raise Exception('--batch_size must be at least 1')
+        if options['flush_every'] < 1:
+            raise Exception('--flush_every must be at least 1')
+        if options['workers'] < 1:
+            raise Exception('--workers must be at least 1')
         
         file_extension = os.path.splitext(options['book_name'])[1]
-        
-        if file_extension == '.epub':
+
+        if options['enqueue']:
+            self.enqueue(options, file_extension)
+            return
+
+        telemetry.reset()
+        if options['export_only']:
+            self.export(options, file_extension)
+        elif file_extension == '.epub':
             self.translate_epub(options)
         elif file_extension == '.idml':
             self.translate_idml(options)
+        self.report_metrics(options)
+
+    def enqueue(self, options, file_extension):
+        # Stored on the job and passed to TEPUB/IDMLParser by every worker
+        if file_extension == '.epub':
+            job_options = {
+                'mirror': options['mirror'],
+                'concurrency': options['concurrency'],
+                'batch_size': options['batch_size'],
+                'flush_every': options['flush_every'],
+                'flush_seconds': options['flush_seconds'],
+                'parser': options['parser'],
+                'batch_tokens': options['batch_tokens'],
+            }
+        else:
+            job_options = {
+                'batch_size': options['batch_size'],
+                'flush_every': options['flush_every'],
+                'flush_seconds': options['flush_seconds'],
+                'batch_tokens': options['batch_tokens'],
+                'stream': options['stream'],
+            }
+        # Jobs are per language; each is translated and assembled on its own
+        for lang_to in options['lang_to']:
+            job = enqueue(options['book_name'], options['lang_from'], lang_to, job_options)
+            self.stdout.write(self.style.SUCCESS(
+                f'Queued job {job.id} ({lang_to}) with {job.units.count()} work units; '
+                f'run manage.py translate_worker to process it.'
+            ))
+
+    def export(self, options, file_extension):
+        if file_extension == '.epub':
+            e = ExportTEPUB(
+                options['book_name'], options['lang_from'], options['lang_to'], options.get('mirror', False),
+                flush_every=options['flush_every'], flush_seconds=options['flush_seconds'], parser=options['parser'],
+            )
+            e.translate_book()
+            output_files = [e.get_output_name(target) for target in e.targets]
+        else:
+            output_files = []
+            for lang_to in options['lang_to']:
+                output_file = self.get_idml_output_name(options, lang_to)
+                IDMLWriter(options['book_name'], output_file, lang_to, options['stream']).write()
+                output_files.append(output_file)
+        for output_file in output_files:
+            self.stdout.write(self.style.SUCCESS(f'Exported {output_file} from stored translations.'))
 
     def translate_epub(self, options):
         mirror = options.get('mirror', False)
-        e = TEPUB(options['book_name'], options['lang_from'], options['lang_to'], mirror)
+        tepub_class = StreamingTEPUB if options.get('stream') else TEPUB
+        e = tepub_class(
+            options['book_name'], options['lang_from'], options['lang_to'], mirror,
+            options['concurrency'], options['batch_size'], options['flush_every'], options['flush_seconds'],
+            options['parser'], options['batch_tokens'], options['combined_prompt'],
+        )
         e.translate_book()
+        self.print_memory_stats(e.targets)
+
+    def report_metrics(self, options):
+        summary = telemetry.summary()
+        stages = ', '.join(f"{name} {stage['seconds']:.1f}s" for name, stage in summary['stages'].items())
+        llm = summary['llm']
+        self.stdout.write(f"Time by stage: {stages} (wall {summary['wall_seconds']:.1f}s)")
+        if llm['requests']:
+            self.stdout.write(
+                f"LLM: {llm['requests']} requests, {llm['errors']} errors, "
+                f"latency p50 {llm['latency_p50'] or 0:.2f}s p90 {llm['latency_p90'] or 0:.2f}s "
+                f"p99 {llm['latency_p99'] or 0:.2f}s, "
+                f"{llm['prompt_tokens']} prompt + {llm['completion_tokens']} completion tokens"
+            )
+        self.stdout.write(f"{summary['elements']} elements, {summary['elements_per_second']} elements/s")
+        if options['metrics_json']:
+            telemetry.write_json(options['metrics_json'])
+        if options['metrics_prom']:
+            telemetry.write_prometheus(options['metrics_prom'])
+
+    def print_memory_stats(self, targets):
+        for target in targets:
+            self.stdout.write(
+                f'Translation memory ({target.name}): {target.memory.hits} hits, {target.memory.misses} misses'
+            )
 
     def translate_idml(self, options):
         self.stdout.write(self.style.WARNING('Starting IDML translation...'))
         
-        idml_parser = IDMLParser(options['book_name'], options['lang_from'], options['lang_to'])
+        idml_parser = IDMLParser(
+            options['book_name'], options['lang_from'], options['lang_to'], options['batch_size'],
+            options['flush_every'], options['flush_seconds'], options['batch_tokens'], options['workers'],
+            options['stream'], options['combined_prompt'],
+        )
         idml_parser.parse()
+        self.print_memory_stats(idml_parser.targets)
 
         self.stdout.write(self.style.SUCCESS('IDML file parsed and translations saved/updated.'))
 
-        output_file = f"{os.path.splitext(options['book_name'])[0]}_{options['lang_from']}_to_{options['lang_to']}.idml"
-        idml_writer = IDMLWriter(options['book_name'], output_file, options['lang_to'])
-        idml_writer.write()
+        for lang_to in options['lang_to']:
+            output_file = self.get_idml_output_name(options, lang_to)
+            idml_writer = IDMLWriter(options['book_name'], output_file, lang_to, options['stream'])
+            idml_writer.write()
 
-        self.stdout.write(self.style.SUCCESS(f'Successfully created translated IDML file: {output_file}'))
+            self.stdout.write(self.style.SUCCESS(f'Successfully created translated IDML file: {output_file}'))
+
+    def get_idml_output_name(self, options, lang_to):
+        return f"{os.path.splitext(options['book_name'])[0]}_{options['lang_from']}_to_{lang_to}.idml"
 
     def print_idml_structure(self, file_path):
         with zipfile.ZipFile(file_path, 'r') as zip_ref:
@@ -98,171 +282,3 @@ class Command(BaseCommand):
         self.stdout.write('  ' * level + f"{element.tag}: {element.attrib}")
         for child in element:
             self.print_xml_structure(child, level + 1)
-
-class TEPUB:
-    def __init__(self, epub_name, lang_from, lang_to, mirror=False):
-        self.epub_name = epub_name
-        self.translate_model = ChatGPT()
-        self.origin_book = epub.read_epub(self.epub_name)
-        self.lang_from = lang_from
-        self.lang_to = lang_to
-        self.mirror = mirror
-
-    def get_item_info(self, item):
-        info = {
-            'id': item.id,
-            'file_name': item.file_name,
-            'media_type': item.media_type,
-            'is_linear': item.is_linear,
-            'manifest': item.manifest,
-            'type': item.get_type(),
-        }
-        
-        # Check if it might be a chapter
-        is_chapter = False
-        heading = None
-        subheading = None
-        if info['type'] == 9:  # ITEM_DOCUMENT
-            content = item.content.decode('utf-8')
-            content_lower = content.lower()
-            # print(content)
-            
-            # Extract the content of the first h1 tag
-            soup = bs(content, 'html.parser')
-            first_h1 = soup.find('h1')
-            if first_h1:
-                heading = first_h1.get_text(strip=True)
-            first_h2 = soup.find('h2')
-            if first_h2:
-                subheading = first_h2.get_text(strip=True)
-
-            # Check if 'chapter' is in the heading or subheading
-            if (heading and 'chapter' in heading.lower()) or (subheading and 'chapter' in subheading.lower()):
-                is_chapter = True
-            else:
-                # Exclude common non-chapter items
-                excluded_terms = ['table of contents']
-                if any(term in info['file_name'].lower() or term in content_lower for term in excluded_terms):
-                    is_chapter = False
-                elif 'chapter' in info['file_name'].lower() or 'chapter' in info['id'].lower():
-                    is_chapter = True
-                else:
-                    # Check content for chapter indicators
-                    chapter_indicators = [
-                        r'<h\d[^>]*>chapter',  # <h1>Chapter, <h2>Chapter, etc.
-                        r'<h\d[^>]*>\s*\d+',   # <h1>1, <h2>2, etc.
-                        r'class=["\']chapter'  # class="chapter-title", etc.
-                    ]
-                    if any(re.search(pattern, content_lower) for pattern in chapter_indicators):
-                        is_chapter = True
-
-        info['is_chapter'] = is_chapter
-        info['heading'] = heading
-        info['subheading'] = subheading
-        
-        return info
-
-    def translate_book(self):
-        base_name = os.path.basename(self.epub_name)
-        name = os.path.splitext(base_name)[0]
-
-        book, created = Book.objects.get_or_create(file_name=base_name)
-
-        new_book = epub.EpubBook()
-        new_book.metadata = self.origin_book.metadata
-        new_book.spine = self.origin_book.spine
-        new_book.toc = self.origin_book.toc
-
-        for item_index, i in enumerate(self.origin_book.get_items()):
-
-            item_info = self.get_item_info(i)
-            print(f"Item {item_index}:")
-            for key, value in item_info.items():
-                print(f"  {key}: {value}")
-            print()
-
-            if i.get_type() == 9:
-
-                book_item, item_created = BookItem.objects.get_or_create(
-                    book=book,
-                    item_id=item_index,
-                    item_type=i.get_type(),
-                    defaults={
-                        'content': i.content,
-                        'heading': item_info.get('heading', ''),
-                        'subheading': item_info.get('subheading', ''),
-                        'is_chapter': item_info.get('is_chapter', False)
-                    }
-                )
-
-                # this can be used to correct old errors in content saving;
-                #this can/should be deleted later
-                book_item.content = i.content
-                book_item.heading = item_info.get('heading', '')
-                book_item.subheading = item_info.get('subheading', '')
-                book_item.is_chapter = item_info.get('is_chapter', False)
-                book_item.save()
-
-                soup = bs(i.content, "html.parser")
-                element_types = ['h1', 'h2', 'h3', 'h4', 'p', 'li']
-                p_list = soup.findAll(element_types)
-
-                for element_index, p in enumerate(p_list):
-                    if p.text and not p.text.isdigit():
-
-                        # Check if the book item element exists in the database for the specific language
-                        book_item_element = BookItemElement.objects.filter(
-                            book_item=book_item,
-                            element_id=element_index,
-                            element_type=p.name,
-                            language__name=self.lang_to
-                        ).first()
-
-                        if book_item_element:
-                            translation = book_item_element.translated_content
-                        else:
-                            # If the element doesn't exist, translate and save it to the database
-                            translation = self.translate_model.translate(p.text, self.lang_from, self.lang_to)
-                            language, _ = Language.objects.get_or_create(name=self.lang_to)
-                            book_item_element = BookItemElement.objects.create(
-                                book_item=book_item,
-                                element_id=element_index,
-                                element_type=p.name,
-                                content=p.text,
-                                translated_content=translation,
-                                language=language,
-                                complete=False
-                            )
-                            
-                        # Save the translation and create a TranslationVersion entry
-                        book_item_element.save_translation(translation, is_machine_translation=True)
-
-                        # Split translation into lines and create HTML with <br> for line breaks
-                        translation_lines = translation.split('\n')
-                        new_p_contents = soup.new_tag("span")  # Using span to insert HTML content inside p tag
-                        for line in translation_lines:
-                            if new_p_contents.contents:  # If not the first line, add a <br> before adding next line
-                                new_p_contents.append(soup.new_tag("br"))
-                            new_p_contents.append(soup.new_string(line))
-
-                        new_p = soup.new_tag("p")
-                        new_p.insert(0, new_p_contents)
-
-                        if self.mirror:
-                            p.insert_after(new_p)
-                        else:
-                            p.replace_with(new_p)
-                        
-
-                i.content = soup.prettify().encode()
-
-            new_book.add_item(i)
-
-        # name = self.epub_name.split(".")[0]
-        # epub.write_epub(f"{name}_{self.lang_from}_to_{self.lang_to}.epub", new_book, {})
-        if self.mirror:
-            epub.write_epub(f"{name}_{self.lang_from}_to_{self.lang_to}_mirrored.epub", new_book, {})
-        else:
-            epub.write_epub(f"{name}_{self.lang_from}_to_{self.lang_to}.epub", new_book, {})
-
-
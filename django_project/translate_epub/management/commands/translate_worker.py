@@ -0,0 +1,65 @@
+import os
+import socket
+
+from django.core.management.base import BaseCommand
+
+from translate_epub.models import TranslationJob, WorkUnit
+from translate_epub.work_queue import QueueWorker
+
+
+class Command(BaseCommand):
+    help = 'Translates work units of queued books (see translate_epub --enqueue)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--worker_id',
+            dest='worker_id',
+            type=str,
+            default=f'{socket.gethostname()}:{os.getpid()}',
+            help='name this worker records on the units it leases',
+        )
+        parser.add_argument(
+            '--lease_seconds',
+            dest='lease_seconds',
+            type=int,
+            default=300,
+            help='a unit is handed to another worker if its lease is not renewed for this long',
+        )
+        parser.add_argument(
+            '--max_attempts',
+            dest='max_attempts',
+            type=int,
+            default=3,
+            help='give up on a unit (and its job) after this many attempts',
+        )
+        parser.add_argument(
+            '--poll_seconds',
+            dest='poll_seconds',
+            type=float,
+            default=0,
+            help='keep waiting for new units, checking every N seconds; 0 exits once the queue is empty',
+        )
+        parser.add_argument(
+            '--assemble',
+            dest='assemble',
+            type=int,
+            help='only (re)build the output file of the given job id',
+        )
+
+    def handle(self, *args, **options):
+        if options['lease_seconds'] < 3:
+            raise Exception('--lease_seconds must be at least 3')
+        if options['max_attempts'] < 1:
+            raise Exception('--max_attempts must be at least 1')
+
+        worker = QueueWorker(options['worker_id'], options['lease_seconds'], options['max_attempts'])
+
+        if options['assemble']:
+            job = TranslationJob.objects.select_related('book', 'language').get(pk=options['assemble'])
+            if job.units.exclude(status=WorkUnit.DONE).exists():
+                raise Exception(f'job {job.id} still has units that are not done')
+            worker.assemble(job)
+            return
+
+        processed = worker.run(options['poll_seconds'])
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} work unit(s).'))
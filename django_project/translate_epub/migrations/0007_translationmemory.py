@@ -0,0 +1,29 @@
+# Generated by Django 5.0.6 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0006_alter_bookitem_item_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranslationMemory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('lang_from', models.CharField(max_length=100)),
+                ('lang_to', models.CharField(max_length=100)),
+                ('model', models.CharField(max_length=255)),
+                ('prompt_version', models.CharField(max_length=50)),
+                ('source_text', models.TextField()),
+                ('translated_text', models.TextField()),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0007_translationmemory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookitem',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='bookitemelement',
+            name='source_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.CreateModel(
+            name='BookItemRender',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mirror', models.BooleanField(default=False)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('book_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renders', to='translate_epub.bookitem')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='translate_epub.language')),
+            ],
+            options={
+                'unique_together': {('book_item', 'language', 'mirror')},
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0008_bookitem_content_hash_bookitemelement_source_hash_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TranslationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_path', models.CharField(max_length=1024)),
+                ('lang_from', models.CharField(max_length=100)),
+                ('options', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('assembling', 'Assembling'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('output_path', models.CharField(blank=True, default='', max_length=1024)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='translate_epub.book')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='translate_epub.language')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WorkUnit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=1024)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='units', to='translate_epub.translationjob')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'lease_expires_at'], name='translate_e_status_69ce01_idx')],
+            },
+        ),
+    ]
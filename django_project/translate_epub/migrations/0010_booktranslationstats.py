@@ -0,0 +1,64 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_stats(apps, schema_editor):
+    BookItemElement = apps.get_model('translate_epub', 'BookItemElement')
+    BookTranslationStats = apps.get_model('translate_epub', 'BookTranslationStats')
+
+    # Elements with a version written by a person are no longer machine translations
+    # (ids are read first; MySQL can't update a table it selects from in a subquery)
+    edited = list(
+        BookItemElement.objects.filter(versions__is_machine_translation=False).values_list('pk', flat=True).distinct()
+    )
+    for start in range(0, len(edited), 1000):
+        BookItemElement.objects.filter(pk__in=edited[start:start + 1000]).update(machine_translated=False)
+
+    BookTranslationStats.objects.bulk_create([
+        BookTranslationStats(
+            book_id=row['book_item__book'],
+            language_id=row['language'],
+            total=row['total'],
+            complete=row['complete'],
+            machine_translated=row['machine_translated'],
+        )
+        for row in BookItemElement.objects.values('book_item__book', 'language').annotate(
+            total=Count('id'),
+            complete=Count('id', filter=Q(complete=True)),
+            machine_translated=Count('id', filter=Q(machine_translated=True)),
+        ).order_by()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0009_translationjob_workunit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookitemelement',
+            name='machine_translated',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.CreateModel(
+            name='BookTranslationStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('complete', models.PositiveIntegerField(default=0)),
+                ('machine_translated', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='translation_stats', to='translate_epub.book')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='translate_epub.language')),
+            ],
+            options={
+                'unique_together': {('book', 'language')},
+            },
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
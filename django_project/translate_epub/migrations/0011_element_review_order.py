@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0010_booktranslationstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bookitemelement',
+            index=models.Index(fields=['language', 'book_item', 'element_id'], name='element_review_order'),
+        ),
+    ]
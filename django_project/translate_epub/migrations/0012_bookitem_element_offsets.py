@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0011_element_review_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookitem',
+            name='element_offsets',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0012_bookitem_element_offsets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Passage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('first_element', models.IntegerField()),
+                ('last_element', models.IntegerField()),
+                ('text', models.TextField()),
+                ('length', models.PositiveIntegerField()),
+                ('book_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='passages', to='translate_epub.bookitem')),
+            ],
+            options={
+                'unique_together': {('book_item', 'position')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PassageTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_collation='utf8mb4_bin', max_length=100)),
+                ('frequency', models.PositiveIntegerField()),
+                ('passage', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='translate_epub.passage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['term'], name='passage_term')],
+                'unique_together': {('passage', 'term')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:30
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0013_passage_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answer',
+            name='complete',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='answer',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
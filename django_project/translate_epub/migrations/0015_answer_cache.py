@@ -0,0 +1,27 @@
+# Generated by Django 5.0.6 on 2026-10-18 18:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('translate_epub', '0014_answer_streaming'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('model', models.CharField(max_length=255)),
+                ('question', models.TextField()),
+                ('content', models.TextField(db_collation='utf8mb4_unicode_ci')),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -1,5 +1,15 @@
+import hashlib
+
 from django.db import models
+from django.db.models import Count, F, Q
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+
+def hash_content(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
 
 class Book(models.Model):
     file_name = models.CharField(max_length=255, unique=True)
@@ -17,6 +27,10 @@ class BookItem(models.Model):
     heading = models.CharField(max_length=255, null=True, blank=True)
     subheading = models.CharField(max_length=255, null=True, blank=True)
     is_chapter = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # [start, end] of every translatable element in content, for splicing in translations;
+    # empty when the document can't be spliced
+    element_offsets = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -26,6 +40,22 @@ class BookItem(models.Model):
     class Meta:
         unique_together = ('book', 'item_id')
 
+class BookItemRender(models.Model):
+    # Translated output of a document, reused while neither the source nor its elements change
+    book_item = models.ForeignKey(BookItem, on_delete=models.CASCADE, related_name='renders')
+    language = models.ForeignKey('Language', on_delete=models.CASCADE)
+    mirror = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Render of {self.book_item} in {self.language}"
+
+    class Meta:
+        unique_together = ('book_item', 'language', 'mirror')
+
 class Question(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='questions')
     book_items = models.ManyToManyField(BookItem, related_name='questions')
@@ -39,11 +69,30 @@ class Question(models.Model):
 class Answer(models.Model):
     question = models.OneToOneField(Question, on_delete=models.CASCADE, related_name='answer')
     content = models.TextField(db_collation='utf8mb4_unicode_ci')
+    # False while the answer is being streamed; content holds what has arrived so far
+    complete = models.BooleanField(default=True)
+    # When the generation streaming it started; a generation that stops saving is taken over
+    started_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Answer to: {self.question.title}"
 
+class AnswerCache(models.Model):
+    # sha256 of the normalized question, the context sent with it (see answers.question_context) and the model
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=255)
+    question = models.TextField()
+    content = models.TextField(db_collation='utf8mb4_unicode_ci')
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Least recently used entries are evicted first once the cache is full
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Cached answer to: {self.question[:50]}"
+
 class Language(models.Model):
     name = models.CharField(max_length=100, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -89,9 +138,12 @@ class BookItemElement(models.Model):
     element_id = models.IntegerField()
     element_type = models.CharField(max_length=50)
     content = models.TextField()
+    source_hash = models.CharField(max_length=64, blank=True, default='')
     translated_content = models.TextField()
     language = models.ForeignKey('Language', on_delete=models.CASCADE)
     complete = models.BooleanField(default=False)
+    # False once a person has edited the translation
+    machine_translated = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -100,6 +152,16 @@ class BookItemElement(models.Model):
 
     class Meta:
         unique_together = ('book_item', 'element_id', 'language')
+        indexes = [
+            # Keyset pagination of the review view: one language, ordered by (book_item, element_id)
+            models.Index(fields=['language', 'book_item', 'element_id'], name='element_review_order'),
+        ]
+
+    def has_source(self, content, source_hash):
+        # Rows stored before source_hash existed are compared on their text
+        if self.source_hash:
+            return self.source_hash == source_hash
+        return self.content == content
 
     def save_translation(self, translated_content, user=None, is_machine_translation=False):
         # Check if the content has actually changed
@@ -112,6 +174,7 @@ class BookItemElement(models.Model):
         
         # Content has changed, create a new version
         self.translated_content = translated_content
+        self.machine_translated = is_machine_translation
         self.save()
         
         new_version = TranslationVersion.objects.create(
@@ -122,3 +185,161 @@ class BookItemElement(models.Model):
         )
         return new_version
 
+    def build_version(self, user=None, is_machine_translation=False):
+        # Unsaved TranslationVersion for bulk_create, which skips TranslationVersion.save()
+        return TranslationVersion(
+            book_item_element=self,
+            translated_content=self.translated_content,
+            user=user,
+            is_machine_translation=is_machine_translation,
+            book_item_id=self.book_item_id,
+            element_id=self.element_id,
+            element_type=self.element_type,
+            language_id=self.language_id,
+        )
+
+
+class TranslationMemory(models.Model):
+    # sha256 of the normalized source text, language pair, model and prompt version
+    key = models.CharField(max_length=64, unique=True)
+    lang_from = models.CharField(max_length=100)
+    lang_to = models.CharField(max_length=100)
+    model = models.CharField(max_length=255)
+    prompt_version = models.CharField(max_length=50)
+    source_text = models.TextField()
+    translated_text = models.TextField()
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.lang_from} -> {self.lang_to}: {self.source_text[:50]}"
+
+
+class BookTranslationStats(models.Model):
+    # Progress of a book in one language, kept current by TranslationWriter and the review views
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='translation_stats')
+    language = models.ForeignKey('Language', on_delete=models.CASCADE)
+    total = models.PositiveIntegerField(default=0)
+    complete = models.PositiveIntegerField(default=0)
+    machine_translated = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.book} in {self.language}: {self.complete}/{self.total} complete"
+
+    class Meta:
+        unique_together = ('book', 'language')
+
+    @property
+    def complete_percent(self):
+        return round(100 * self.complete / self.total) if self.total else 0
+
+    @property
+    def machine_translated_percent(self):
+        return round(100 * self.machine_translated / self.total) if self.total else 0
+
+    @classmethod
+    def refresh(cls, book_id, language_id):
+        """Create the first row of a pair from a recount of BookItemElement.
+
+        Returns False if another writer created the row first.
+        """
+        counts = BookItemElement.objects.filter(book_item__book_id=book_id, language_id=language_id).aggregate(
+            total=Count('id'),
+            complete=Count('id', filter=Q(complete=True)),
+            machine_translated=Count('id', filter=Q(machine_translated=True)),
+        )
+        _, created = cls.objects.get_or_create(book_id=book_id, language_id=language_id, defaults=counts)
+        return created
+
+    @classmethod
+    def apply(cls, book_id, language_id, total=0, complete=0, machine_translated=0):
+        """Add the given changes to the counts of a (book, language) pair."""
+        updated = cls.objects.filter(book_id=book_id, language_id=language_id).update(
+            total=F('total') + total,
+            complete=F('complete') + complete,
+            machine_translated=F('machine_translated') + machine_translated,
+            updated_at=timezone.now(),
+        )
+        if not updated and not cls.refresh(book_id, language_id):
+            # Its recount couldn't see our uncommitted rows, so add our changes to it
+            cls.apply(book_id, language_id, total, complete, machine_translated)
+
+
+class Passage(models.Model):
+    # A run of consecutive elements of an item, the unit ask_question retrieves
+    book_item = models.ForeignKey(BookItem, on_delete=models.CASCADE, related_name='passages')
+    position = models.PositiveIntegerField()
+    first_element = models.IntegerField()
+    last_element = models.IntegerField()
+    text = models.TextField()  # source text
+    length = models.PositiveIntegerField()  # number of indexed terms, for BM25 length normalization
+
+    def __str__(self):
+        return f"Passage {self.position} of {self.book_item}"
+
+    class Meta:
+        unique_together = ('book_item', 'position')
+
+
+class PassageTerm(models.Model):
+    # Inverted index: how often a term occurs in a passage
+    passage = models.ForeignKey(Passage, on_delete=models.CASCADE, related_name='terms')
+    term = models.CharField(max_length=100, db_collation='utf8mb4_bin')  # 'a' and 'à' are different terms
+    frequency = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.term} x{self.frequency} in {self.passage}"
+
+    class Meta:
+        unique_together = ('passage', 'term')
+        indexes = [models.Index(fields=['term'], name='passage_term')]
+
+
+class TranslationJob(models.Model):
+    # A book queued for translation by translate_worker processes
+    PENDING = 'pending'
+    ASSEMBLING = 'assembling'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (ASSEMBLING, 'Assembling'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='jobs')
+    language = models.ForeignKey('Language', on_delete=models.CASCADE)
+    file_path = models.CharField(max_length=1024)
+    lang_from = models.CharField(max_length=100)
+    options = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    output_path = models.CharField(max_length=1024, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Job {self.id}: {self.book} to {self.language} ({self.status})"
+
+
+class WorkUnit(models.Model):
+    # One epub document or idml story of a job, leased to one worker at a time
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    job = models.ForeignKey(TranslationJob, on_delete=models.CASCADE, related_name='units')
+    name = models.CharField(max_length=1024)  # zip entry of the document or story
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    worker = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} of job {self.job_id} ({self.status})"
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'lease_expires_at'])]
@@ -0,0 +1,257 @@
+import math
+import re
+from collections import Counter, defaultdict
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import Avg, Count
+
+from .models import BookItem, BookItemElement, Passage, PassageTerm
+from .segmenter import count_tokens
+
+# Consecutive elements are joined into passages of about this many words of source text
+PASSAGE_WORDS = 120
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+TERM = re.compile(r'\w+')
+# Chinese and Japanese are written without spaces, so their runs are indexed as character bigrams
+CJK = re.compile(r'([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)')
+MAX_TERM_LENGTH = 100
+
+
+def tokenize(text):
+    terms = []
+    for word in TERM.findall(text.lower()):
+        for n, part in enumerate(CJK.split(word)):
+            if n % 2:
+                terms.extend([part] if len(part) == 1 else [part[i:i + 2] for i in range(len(part) - 1)])
+            elif part and len(part) <= MAX_TERM_LENGTH:
+                terms.append(part)
+    return terms
+
+
+def load_elements(book_item_id, first_element=None, last_element=None):
+    """[(element_id, source text, [translations])] of an item, in order.
+
+    Translations in every language are indexed along with the source, so a
+    question asked in either language finds the passage.
+    """
+    rows = BookItemElement.objects.filter(book_item_id=book_item_id)
+    if first_element is not None:
+        rows = rows.filter(element_id__gte=first_element)
+    if last_element is not None:
+        rows = rows.filter(element_id__lte=last_element)
+    rows = rows.order_by('element_id').values_list('element_id', 'content', 'translated_content')
+    elements = []
+    for element_id, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        elements.append((element_id, group[0][1], [translation for _, _, translation in group]))
+    return elements
+
+
+def passage_fields(elements):
+    text = '\n'.join(source.strip() for _, source, _ in elements if source.strip())
+    terms = Counter(tokenize(text))
+    for _, _, translations in elements:
+        for translation in translations:
+            terms.update(tokenize(translation))
+    return text, terms
+
+
+def group_elements(elements):
+    """Split elements, in order, into runs of about PASSAGE_WORDS words of source text."""
+    groups = []
+    current = []
+    words = 0
+    for element in elements:
+        current.append(element)
+        words += len(tokenize(element[1]))
+        if words >= PASSAGE_WORDS:
+            groups.append(current)
+            current = []
+            words = 0
+    if current:
+        groups.append(current)
+    return groups
+
+
+def save_terms(passages_terms):
+    PassageTerm.objects.bulk_create(
+        [
+            PassageTerm(passage_id=passage_id, term=term, frequency=frequency)
+            for passage_id, terms in passages_terms
+            for term, frequency in terms.items()
+        ],
+        batch_size=1000,
+    )
+
+
+def create_passages(book_item_id, elements, start=0):
+    # Passages for the elements, numbered from ``start``
+    passages = []
+    counts = []
+    for position, group in enumerate(group_elements(elements), start):
+        text, terms = passage_fields(group)
+        passages.append(Passage(
+            book_item_id=book_item_id,
+            position=position,
+            first_element=group[0][0],
+            last_element=group[-1][0],
+            text=text,
+            length=sum(terms.values()),
+        ))
+        counts.append(terms)
+    Passage.objects.bulk_create(passages)
+    # MySQL can't return ids from a bulk insert
+    ids = dict(
+        Passage.objects.filter(book_item_id=book_item_id, position__gte=start).values_list('position', 'id')
+    )
+    save_terms([(ids[passage.position], terms) for passage, terms in zip(passages, counts)])
+
+
+def index_item(book_item_id):
+    """Rebuild the passages of one item from its stored elements."""
+    with transaction.atomic():
+        Passage.objects.filter(book_item_id=book_item_id).delete()
+        create_passages(book_item_id, load_elements(book_item_id))
+
+
+def extend_item(last_passage):
+    """Regroup an item from its last passage on, after elements were stored past it.
+
+    The passages before it are full, so this gives the same passages as
+    index_item without reading the rest of the item again.
+    """
+    with transaction.atomic():
+        last_passage.delete()
+        create_passages(
+            last_passage.book_item_id,
+            load_elements(last_passage.book_item_id, last_passage.first_element),
+            last_passage.position,
+        )
+
+
+def update_index(elements):
+    """Bring the index up to date after the given (book_item_id, element_id) pairs were written.
+
+    Passages covering the elements are recomputed in place.  Elements stored
+    past an item's last passage, as when a document is being imported, regroup
+    the item from that passage on; an item with any other element outside its
+    passages (or no passages yet) is rebuilt.
+    """
+    by_item = defaultdict(set)
+    for book_item_id, element_id in elements:
+        by_item[book_item_id].add(element_id)
+    if not by_item:
+        return
+
+    passages = defaultdict(list)
+    for passage in Passage.objects.filter(book_item_id__in=by_item).only(
+        'id', 'book_item_id', 'position', 'first_element', 'last_element'
+    ):
+        passages[passage.book_item_id].append(passage)
+
+    with transaction.atomic():
+        for book_item_id, element_ids in by_item.items():
+            covering = [
+                passage for passage in passages[book_item_id]
+                if any(passage.first_element <= element_id <= passage.last_element for element_id in element_ids)
+            ]
+            covered = {
+                element_id for element_id in element_ids
+                if any(passage.first_element <= element_id <= passage.last_element for passage in covering)
+            }
+            added = element_ids - covered
+            last_passage = max(passages[book_item_id], key=lambda passage: passage.position, default=None)
+            if added and (last_passage is None or min(added) <= last_passage.last_element):
+                index_item(book_item_id)
+                continue
+            if added:
+                # Regrouped below, along with the new elements
+                covering = [passage for passage in covering if passage is not last_passage]
+
+            updated = []
+            for passage in covering:
+                passage.text, terms = passage_fields(
+                    load_elements(book_item_id, passage.first_element, passage.last_element)
+                )
+                passage.length = sum(terms.values())
+                updated.append((passage, terms))
+            Passage.objects.bulk_update([passage for passage, _ in updated], ['text', 'length'])
+            PassageTerm.objects.filter(passage__in=[passage for passage, _ in updated]).delete()
+            save_terms([(passage.pk, terms) for passage, terms in updated])
+            if added:
+                extend_item(last_passage)
+
+
+def ensure_indexed(book_items):
+    # Items stored before the index existed
+    for book_item_id in BookItem.objects.filter(
+        pk__in=[book_item.pk for book_item in book_items], passages__isnull=True
+    ).values_list('id', flat=True):
+        index_item(book_item_id)
+
+
+def search(book_items, question, top_k=8):
+    """Passages of ``book_items`` ranked by BM25 against ``question``, best first."""
+    terms = set(tokenize(question))
+    passages = Passage.objects.filter(book_item__in=book_items)
+    totals = passages.aggregate(count=Count('id'), average_length=Avg('length'))
+    if not terms or not totals['count']:
+        return []
+
+    postings = PassageTerm.objects.filter(passage__in=passages, term__in=terms).values_list(
+        'passage_id', 'term', 'frequency', 'passage__length'
+    )
+    document_frequency = Counter()
+    matches = defaultdict(list)
+    for passage_id, term, frequency, length in postings:
+        document_frequency[term] += 1
+        matches[passage_id].append((term, frequency, length))
+
+    count = totals['count']
+    average_length = totals['average_length'] or 1
+    scores = {}
+    for passage_id, passage_terms in matches.items():
+        score = 0
+        for term, frequency, length in passage_terms:
+            idf = math.log(1 + (count - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+        scores[passage_id] = score
+
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    found = Passage.objects.select_related('book_item').in_bulk(best)
+    return [found[passage_id] for passage_id in best]
+
+
+def build_context(book_items, question, top_k=8, max_tokens=3000):
+    """Plain-text context for ChatGPT.ask: the best passages that fit in ``max_tokens``, in book order.
+
+    Its size depends on ``top_k`` and ``max_tokens``, not on how many items
+    are selected.  When nothing matches the question, the opening passages
+    of the selection are used instead.
+    """
+    ensure_indexed(book_items)
+    passages = search(book_items, question, top_k)
+    if not passages:
+        passages = list(
+            Passage.objects.filter(book_item__in=book_items).select_related('book_item')
+            .order_by('book_item_id', 'position')[:top_k]
+        )
+
+    selected = []
+    tokens = 0
+    for passage in passages:
+        passage_tokens = count_tokens(passage.text)
+        if selected and tokens + passage_tokens > max_tokens:
+            break
+        selected.append(passage)
+        tokens += passage_tokens
+
+    selected.sort(key=lambda passage: (passage.book_item_id, passage.position))
+    parts = []
+    for passage in selected:
+        heading = passage.book_item.heading or f'Item {passage.book_item.item_id}'
+        parts.append(f'[{heading}]\n{passage.text}')
+    return '\n\n'.join(parts)
@@ -0,0 +1,219 @@
+import asyncio
+import random
+import threading
+import time
+
+import environ
+import openai
+
+from .telemetry import telemetry
+
+env = environ.Env()
+environ.Env.read_env()
+
+API_RPM = env.int('API_RPM', default=0)
+API_TPM = env.int('API_TPM', default=0)
+API_MAX_RETRIES = env.int('API_MAX_RETRIES', default=6)
+API_MAX_CONCURRENCY = env.int('API_MAX_CONCURRENCY', default=32)
+
+
+class TokenBucket:
+    """Allows ``rate`` units per minute, with bursts up to one minute's worth."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def take(self, amount):
+        """Take ``amount`` if it is available and return 0, or return how long to wait for it."""
+        if not self.rate:
+            return 0
+        # A single request larger than the whole budget still has to go through eventually
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) * 60 / self.rate
+
+    def acquire(self, amount):
+        while True:
+            wait = self.take(amount)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, amount):
+        while True:
+            wait = self.take(amount)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, amount):
+        """Correct an earlier estimate once the real usage is known."""
+        if not self.rate:
+            return
+        with self.lock:
+            self.refill()
+            self.tokens -= amount
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that grows while requests succeed and shrinks on errors.
+
+    Additive increase (about one slot per limit's worth of successes);
+    multiplicative decrease, by half, on rate limits and server errors.
+    Latency is compared per token, so long and short requests can be mixed:
+    while the recent average runs well above the long-run average the limit
+    stops growing and is trimmed gently, at most once per limit's worth of
+    requests.
+    """
+
+    # Weights of the newest sample in the recent and long-run averages of latency per token
+    RECENT_WEIGHT = 0.2
+    BASELINE_WEIGHT = 0.005
+    # How far above the baseline the recent latency may go before the limit is trimmed
+    LATENCY_TOLERANCE = 2
+
+    def __init__(self, maximum, minimum=1, initial=None):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or max(minimum, maximum // 4))
+        self.in_flight = 0
+        self.recent_latency = None
+        self.baseline_latency = None
+        self.since_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, ok, latency=None, tokens=1):
+        with self.condition:
+            self.in_flight -= 1
+            self.since_decrease += 1
+            if not ok:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.since_decrease = 0
+            elif latency is not None:
+                per_token = latency / max(tokens, 1)
+                if self.baseline_latency is None:
+                    self.recent_latency = self.baseline_latency = per_token
+                else:
+                    self.recent_latency += self.RECENT_WEIGHT * (per_token - self.recent_latency)
+                    self.baseline_latency += self.BASELINE_WEIGHT * (per_token - self.baseline_latency)
+                if self.recent_latency > self.baseline_latency * self.LATENCY_TOLERANCE:
+                    if self.since_decrease >= self.limit:
+                        self.limit = max(self.minimum, self.limit * 0.9)
+                        self.since_decrease = 0
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RequestScheduler:
+    """Runs LLM requests under RPM/TPM budgets with adaptive concurrency.
+
+    Requests that fail with 429, 5xx, timeouts or connection errors are
+    retried with jittered exponential backoff, honouring Retry-After when the
+    server sends it.  Other errors are raised straight away.
+    """
+
+    def __init__(self, rpm=API_RPM, tpm=API_TPM, max_retries=API_MAX_RETRIES, max_concurrency=API_MAX_CONCURRENCY,
+                 base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def scale(self, fraction):
+        """Keep only ``fraction`` of the rate limits, e.g. to share them between processes."""
+        self.requests = TokenBucket(self.requests.rate * fraction)
+        self.tokens = TokenBucket(self.tokens.rate * fraction)
+
+    @staticmethod
+    def is_retryable(error):
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    def retry_delay(self, error, attempt):
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return min(self.max_delay, float(retry_after))
+            except ValueError:
+                pass
+        # Full jitter keeps many workers from retrying in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, request, tokens=1):
+        """Run ``request()`` and return its result, retrying transient failures."""
+        for attempt in range(self.max_retries + 1):
+            self.requests.acquire(1)
+            self.tokens.acquire(tokens)
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                result = request()
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                self.limiter.release(ok=not retryable)
+                telemetry.record_llm_error()
+                if not retryable or attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(e, attempt)
+                print(f'Request failed ({e}); retrying in {delay:.1f}s')
+                time.sleep(delay)
+                continue
+
+            latency = time.monotonic() - started
+            usage = getattr(result, 'usage', None)
+            self.limiter.release(ok=True, latency=latency, tokens=getattr(usage, 'total_tokens', None) or tokens)
+            telemetry.record_llm(latency, usage)
+            if usage is not None and getattr(usage, 'total_tokens', None):
+                self.tokens.adjust(usage.total_tokens - tokens)
+            return result
+
+    async def call_async(self, request, tokens=1):
+        """Like call, for a coroutine function; waits on the event loop instead of blocking a thread.
+
+        The RPM/TPM budgets are shared with synchronous requests.  The adaptive
+        concurrency limit is not applied, since waiting on it would block the loop.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.requests.acquire_async(1)
+            await self.tokens.acquire_async(tokens)
+            started = time.monotonic()
+            try:
+                result = await request()
+            except Exception as e:
+                telemetry.record_llm_error()
+                if not self.is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(e, attempt)
+                print(f'Request failed ({e}); retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+
+            telemetry.record_llm(time.monotonic() - started, getattr(result, 'usage', None))
+            return result
+
+
+scheduler = RequestScheduler()
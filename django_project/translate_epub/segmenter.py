@@ -0,0 +1,147 @@
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Split after sentence-ending punctuation (and any closing quotes or brackets),
+# keeping the whitespace so the text can be put back together exactly.
+# Chinese and Japanese put no space between sentences, so after their full-width
+# punctuation (and an ellipsis) the whitespace is optional.
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…。！？])([\'"”’»)\]」』）]*)(\s*)')
+UNSPACED_SENTENCE_END = '。！？…'
+# Kana, CJK ideographs, Hangul syllables and full-width forms: about a token each
+WIDE_CHARACTER = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Number of tokens in ``text``; exact with tiktoken, estimated otherwise."""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        return len(_encoding.encode(text, disallowed_special=()))
+    # About four characters per token for alphabetic scripts
+    wide = len(WIDE_CHARACTER.findall(text))
+    return wide + (len(text) - wide) // 4 + 1
+
+
+def split_sentences(text):
+    """Split ``text`` into ``(sentence, separator)`` pairs; joining them gives back ``text``."""
+    pieces = []
+    start = 0
+    for match in SENTENCE_BOUNDARY.finditer(text):
+        if match.end() == len(text):
+            break
+        if not match.group(2) and text[match.start() - 1] not in UNSPACED_SENTENCE_END:
+            continue
+        end = match.start(2)
+        pieces.append((text[start:end], match.group(2)))
+        start = match.end()
+    pieces.append((text[start:], ''))
+    return pieces
+
+
+def split_characters(word, max_tokens):
+    # Longest runs of characters within the budget, for text written without spaces
+    parts = []
+    start = 0
+    while start < len(word):
+        low, high = start + 1, len(word)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if count_tokens(word[start:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        parts.append(word[start:low])
+        start = low
+    return parts
+
+
+def split_words(sentence, max_tokens):
+    """Last resort for a single sentence that is over budget on its own.
+
+    Splits at whitespace, or between characters where a single word is over
+    budget (Chinese and Japanese have no spaces).  Returns ``(chunk, separator)``
+    pairs like split_text.
+    """
+    pieces = []
+    current = ''
+    current_separator = ''
+    for word, separator in re.findall(r'(\S+)(\s*)', sentence):
+        if count_tokens(word) > max_tokens:
+            if current:
+                pieces.append((current, current_separator))
+            parts = split_characters(word, max_tokens)
+            pieces.extend((part, '') for part in parts[:-1])
+            current = parts[-1]
+        elif current and count_tokens(current + current_separator + word) > max_tokens:
+            pieces.append((current, current_separator))
+            current = word
+        else:
+            current = current + current_separator + word if current else word
+        current_separator = separator
+    if current:
+        pieces.append((current, current_separator))
+    return pieces
+
+
+def split_text(text, max_tokens):
+    """Split ``text`` into chunks of at most ``max_tokens`` at sentence boundaries.
+
+    Returns ``(chunk, separator)`` pairs; the separator is the whitespace that
+    followed the chunk in the original, to be used when reassembling.
+    """
+    if count_tokens(text) <= max_tokens:
+        return [(text, '')]
+
+    chunks = []
+    current = ''
+    current_separator = ''
+    for sentence, separator in split_sentences(text):
+        if count_tokens(sentence) > max_tokens:
+            if current:
+                chunks.append((current, current_separator))
+                current = ''
+            words = split_words(sentence, max_tokens)
+            chunks.extend(words[:-1])
+            chunks.append((words[-1][0], separator))
+            continue
+        if current and count_tokens(current + current_separator + sentence) > max_tokens:
+            chunks.append((current, current_separator))
+            current = ''
+        current = current + current_separator + sentence if current else sentence
+        current_separator = separator
+    if current:
+        chunks.append((current, current_separator))
+    return chunks
+
+
+def join_chunks(translations, separators):
+    return ''.join(translation + separator for translation, separator in zip(translations, separators))
+
+
+def pack(texts, max_items, max_tokens):
+    """Group consecutive texts into batches of at most ``max_items`` and ``max_tokens``.
+
+    Returns lists of indices into ``texts``.  A text that is over the token
+    budget on its own gets a batch to itself.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for index, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
@@ -0,0 +1,95 @@
+import html
+import re
+from html.parser import HTMLParser
+
+TAG = re.compile(r'<[^>]*>')
+
+
+class OffsetParser(HTMLParser):
+    """Finds the source span, start tag to end tag, of every element named in ``names``."""
+
+    def __init__(self, text, names):
+        super().__init__(convert_charrefs=True)
+        self.text = text
+        self.names = set(names)
+        self.line_starts = [0]
+        for match in re.finditer('\n', text):
+            self.line_starts.append(match.end())
+        self.spans = []
+        self.open_elements = []
+        self.valid = True
+
+    def source_offset(self):
+        line, column = self.getpos()
+        return self.line_starts[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.names:
+            self.open_elements.append((tag, len(self.spans)))
+            self.spans.append([tag, self.source_offset(), None])
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.names:
+            start = self.source_offset()
+            self.spans.append([tag, start, self.text.index('>', start) + 1])
+
+    def handle_endtag(self, tag):
+        if tag not in self.names:
+            return
+        # Anything still open inside this element was closed implicitly; its end is unknown
+        while self.open_elements and self.open_elements[-1][0] != tag:
+            self.open_elements.pop()
+            self.valid = False
+        if not self.open_elements:
+            self.valid = False
+            return
+        _, index = self.open_elements.pop()
+        self.spans[index][2] = self.text.index('>', self.source_offset()) + 1
+
+
+def element_offsets(text, elements):
+    """``[start, end]`` of each of the parsed ``elements`` in ``text``, or None.
+
+    ``elements`` are the tags found by BeautifulSoup, in document order.  The
+    spans are only returned if a plain scan of the source finds exactly the
+    same elements with the same text, none of them nested in another, so that
+    each one can be swapped out without touching the markup around it.
+    """
+    parser = OffsetParser(text, {element.name for element in elements})
+    parser.feed(text)
+    parser.close()
+    if not parser.valid or parser.open_elements or len(parser.spans) != len(elements):
+        return None
+
+    offsets = []
+    previous_end = 0
+    for (name, start, end), element in zip(parser.spans, elements):
+        if name != element.name or end is None or start < previous_end:
+            return None
+        if html.unescape(TAG.sub('', text[start:end])) != element.text:
+            return None
+        offsets.append([start, end])
+        previous_end = end
+    return offsets
+
+
+def translation_markup(translation):
+    # Same markup the soup renderer builds: <p><span>line<br/>line</span></p>
+    return '<p><span>' + '<br/>'.join(html.escape(line, quote=False) for line in translation.split('\n')) + '</span></p>'
+
+
+def splice(text, offsets, translations, mirror=False):
+    """Replace (or, mirrored, follow) the elements at ``offsets`` with their translations.
+
+    ``translations`` maps element indices to translated text; everything
+    else in ``text`` is copied unchanged.
+    """
+    parts = []
+    position = 0
+    for index in sorted(translations):
+        start, end = offsets[index]
+        parts.append(text[position:end] if mirror else text[position:start])
+        parts.append(translation_markup(translations[index]))
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
@@ -0,0 +1,102 @@
+from .segmenter import pack
+from .telemetry import telemetry
+from .translation_memory import TranslationMemoryCache
+
+
+def parse_languages(value):
+    """``'German, French'`` -> ``['German', 'French']``; a list is returned as it is."""
+    if isinstance(value, str):
+        value = value.split(',')
+    languages = []
+    for name in value:
+        name = name.strip()
+        if name and name not in languages:
+            languages.append(name)
+    return languages
+
+
+class TargetLanguage:
+    """Per-language state of a run that translates one book into several languages.
+
+    The book is read and its items are stored once; everything that differs by
+    language (the Language row, translation memory, cached renders) hangs off
+    one of these.
+    """
+
+    def __init__(self, lang_from, name):
+        self.name = name
+        self.memory = TranslationMemoryCache(lang_from, name)
+        self.language = None
+        self.renders = {}
+        self.elements_updated_at = {}
+
+    def __repr__(self):
+        return f'<TargetLanguage {self.name}>'
+
+
+def translate_targets(translate_model, lang_from, texts, batch_size, batch_tokens, executor=None, combined=False):
+    """Translate ``texts`` ({target: [text, ...]}) into each target's language.
+
+    Translation memory is checked first for every language.  The misses are
+    packed into batches and sent on ``executor`` (or one after another without
+    one), so the requests of all languages share the same pool and scheduler.
+    With ``combined`` a text missing in several languages is sent once, with a
+    prompt that returns all of them.  Returns {target: [translation, ...]}.
+    """
+    translations = {target: target.memory.lookup(target_texts) for target, target_texts in texts.items()}
+    missing = {
+        target: [n for n, translation in enumerate(translations[target]) if translation is None]
+        for target in texts
+    }
+    run = executor.map if executor is not None else map
+
+    with telemetry.stage('llm'):
+        if combined and sum(1 for indices in missing.values() if indices) > 1:
+            # Every distinct text once, with the targets that still need it
+            needed = {}
+            for target, indices in missing.items():
+                for n in indices:
+                    needed.setdefault(texts[target][n], []).append(target)
+            # Batches only mix texts missing in exactly the same languages, so no text
+            # is translated into a language it already has
+            groups = {}
+            for text, targets in needed.items():
+                groups.setdefault(tuple(targets), []).append(text)
+            jobs = [
+                (targets, [sources[n] for n in batch])
+                for targets, sources in groups.items()
+                for batch in pack(sources, batch_size, batch_tokens)
+            ]
+
+            def translate_batch(job):
+                targets, batch = job
+                return translate_model.translate_languages(batch, lang_from, [target.name for target in targets])
+
+            by_text = {}
+            for (_, batch), results in zip(jobs, run(translate_batch, jobs)):
+                by_text.update(zip(batch, results))
+            for target, indices in missing.items():
+                for n in indices:
+                    translations[target][n] = by_text[texts[target][n]][target.name]
+        else:
+            jobs = [
+                (target, [missing[target][n] for n in batch])
+                for target in texts
+                for batch in pack([texts[target][n] for n in missing[target]], batch_size, batch_tokens)
+            ]
+
+            def translate_batch(job):
+                target, indices = job
+                batch = [texts[target][n] for n in indices]
+                if len(batch) == 1:
+                    return [translate_model.translate(batch[0], lang_from, target.name)]
+                return translate_model.translate_many(batch, lang_from, target.name)
+
+            # map yields results in submission order
+            for (target, indices), results in zip(jobs, run(translate_batch, jobs)):
+                for n, translation in zip(indices, results):
+                    translations[target][n] = translation
+
+    for target, indices in missing.items():
+        target.memory.store([(texts[target][n], translations[target][n]) for n in indices])
+    return translations
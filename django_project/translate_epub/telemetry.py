@@ -0,0 +1,180 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the LLM latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGES = ('parse', 'db', 'llm', 'serialize')
+
+
+class Telemetry:
+    """Collects stage timings and LLM usage for one run.
+
+    Stage time is exclusive: entering a stage pauses the one around it on the
+    same thread, so a DB flush inside a parse counts as DB only and the stage
+    totals add up to the time actually spent.  LLM requests are recorded by
+    the scheduler from whichever thread sends them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.stage_seconds = defaultdict(float)
+            self.stage_calls = defaultdict(int)
+            self.latencies = []
+            self.requests = 0
+            self.errors = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.elements = 0
+
+    @contextmanager
+    def stage(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        now = time.perf_counter()
+        if stack:
+            self.add_stage_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, started = stack.pop()
+            self.add_stage_time(name, now - started, calls=1)
+            if stack:
+                stack[-1][1] = now
+
+    def add_stage_time(self, name, seconds, calls=0):
+        with self.lock:
+            self.stage_seconds[name] += seconds
+            self.stage_calls[name] += calls
+
+    def record_llm(self, latency, usage=None):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if usage is not None:
+                self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+                self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+    def record_llm_error(self):
+        with self.lock:
+            self.requests += 1
+            self.errors += 1
+
+    def count_elements(self, count):
+        with self.lock:
+            self.elements += count
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 4)
+
+    def snapshot(self):
+        """Raw counters, for merging a worker process's numbers into the parent's."""
+        with self.lock:
+            return {
+                'stage_seconds': dict(self.stage_seconds),
+                'stage_calls': dict(self.stage_calls),
+                'latencies': list(self.latencies),
+                'requests': self.requests,
+                'errors': self.errors,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'elements': self.elements,
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, seconds in snapshot['stage_seconds'].items():
+                self.stage_seconds[name] += seconds
+            for name, calls in snapshot['stage_calls'].items():
+                self.stage_calls[name] += calls
+            self.latencies.extend(snapshot['latencies'])
+            self.requests += snapshot['requests']
+            self.errors += snapshot['errors']
+            self.prompt_tokens += snapshot['prompt_tokens']
+            self.completion_tokens += snapshot['completion_tokens']
+            self.elements += snapshot['elements']
+
+    def summary(self):
+        wall = time.monotonic() - self.started
+        return {
+            'wall_seconds': round(wall, 3),
+            'stages': {
+                name: {'seconds': round(self.stage_seconds[name], 3), 'calls': self.stage_calls[name]}
+                for name in sorted(set(STAGES) | set(self.stage_seconds))
+            },
+            'llm': {
+                'requests': self.requests,
+                'errors': self.errors,
+                'latency_p50': self.percentile(0.5),
+                'latency_p90': self.percentile(0.9),
+                'latency_p99': self.percentile(0.99),
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'tokens_per_second': round((self.prompt_tokens + self.completion_tokens) / wall, 1) if wall else 0,
+            },
+            'elements': self.elements,
+            'elements_per_second': round(self.elements / wall, 2) if wall else 0,
+        }
+
+    def prometheus_text(self):
+        lines = [
+            '# HELP translate_stage_seconds_total Time spent in each pipeline stage.',
+            '# TYPE translate_stage_seconds_total counter',
+        ]
+        for name in sorted(set(STAGES) | set(self.stage_seconds)):
+            lines.append(f'translate_stage_seconds_total{{stage="{name}"}} {self.stage_seconds[name]:.6f}')
+        lines += [
+            '# HELP translate_llm_requests_total LLM requests sent, including failed attempts.',
+            '# TYPE translate_llm_requests_total counter',
+            f'translate_llm_requests_total {self.requests}',
+            '# HELP translate_llm_errors_total LLM requests that failed.',
+            '# TYPE translate_llm_errors_total counter',
+            f'translate_llm_errors_total {self.errors}',
+            '# HELP translate_llm_tokens_total Tokens reported by the API.',
+            '# TYPE translate_llm_tokens_total counter',
+            f'translate_llm_tokens_total{{type="prompt"}} {self.prompt_tokens}',
+            f'translate_llm_tokens_total{{type="completion"}} {self.completion_tokens}',
+            '# HELP translate_elements_total Elements translated or reused.',
+            '# TYPE translate_elements_total counter',
+            f'translate_elements_total {self.elements}',
+            '# HELP translate_llm_latency_seconds Latency of successful LLM requests.',
+            '# TYPE translate_llm_latency_seconds histogram',
+        ]
+        for bound in LATENCY_BUCKETS:
+            count = sum(1 for latency in self.latencies if latency <= bound)
+            lines.append(f'translate_llm_latency_seconds_bucket{{le="{bound}"}} {count}')
+        lines += [
+            f'translate_llm_latency_seconds_bucket{{le="+Inf"}} {len(self.latencies)}',
+            f'translate_llm_latency_seconds_sum {sum(self.latencies):.6f}',
+            f'translate_llm_latency_seconds_count {len(self.latencies)}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path):
+        # Written aside and renamed, so the node_exporter textfile collector never reads half a file
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary, path)
+
+
+telemetry = Telemetry()
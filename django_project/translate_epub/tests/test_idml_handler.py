@@ -0,0 +1,33 @@
+import io
+import xml.sax
+
+from django.test import SimpleTestCase
+
+from translate_epub.idml_handler import IDMLWriter, StoryContentHandler
+
+STORY = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<idPkg:Story xmlns:idPkg="http://ns.adobe.com/AdobeInDesign/idml/1.0/packaging">'
+    '<Story Self="u1"><ParagraphStyleRange><CharacterStyleRange>'
+    '<Content>First</Content><Br/><Content>Second<?ACE 7?>tail</Content>'
+    '</CharacterStyleRange></ParagraphStyleRange></Story></idPkg:Story>'
+)
+
+
+class StoryContentHandlerTests(SimpleTestCase):
+    def write_story(self, translations):
+        idml_writer = IDMLWriter('book.idml', 'out.idml', 'French', stream=True)
+        idml_writer.story_ids = {'u1'}
+        idml_writer.translations = translations
+        out = io.BytesIO()
+        xml.sax.parseString(STORY.encode('utf-8'), StoryContentHandler(out, idml_writer))
+        return out.getvalue().decode('utf-8')
+
+    def test_replaces_content_text(self):
+        output = self.write_story({('u1', 1): 'Premier', ('u1', 2): 'Second traduit'})
+        self.assertIn('<Content>Premier</Content><Br/>', output)
+        self.assertIn('<Content>Second traduit<?ACE 7?></Content>', output)
+
+    def test_keeps_text_without_translation(self):
+        output = self.write_story({('u1', 1): 'Premier'})
+        self.assertIn('<Content>Second<?ACE 7?>tail</Content>', output)
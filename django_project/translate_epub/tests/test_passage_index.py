@@ -0,0 +1,111 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from translate_epub import passage_index
+from translate_epub.models import Book, BookItem, BookItemElement, Language, Passage, PassageTerm
+from translate_epub.passage_index import index_item, search, tokenize, update_index
+
+
+class TokenizeTests(TestCase):
+    def test_words_keep_accents(self):
+        self.assertEqual(tokenize("Il a dit qu'il irait à Paris"), ['il', 'a', 'dit', 'qu', 'il', 'irait', 'à', 'paris'])
+
+    def test_cjk_runs_become_bigrams(self):
+        self.assertEqual(tokenize('学校在哪里？'), ['学校', '校在', '在哪', '哪里'])
+        self.assertEqual(tokenize('中'), ['中'])
+        self.assertEqual(tokenize('ABC漢字x'), ['abc', '漢字', 'x'])
+
+    def test_long_cjk_clause_is_kept(self):
+        self.assertEqual(len(tokenize('学' * 150)), 149)
+
+
+class PassageIndexTests(TestCase):
+    def setUp(self):
+        # One passage per element
+        patcher = mock.patch.object(passage_index, 'PASSAGE_WORDS', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        book = Book.objects.create(file_name='index.epub')
+        self.book_item = BookItem.objects.create(book=book, item_id='chapter1', item_type=9, content='')
+        self.language = Language.objects.create(name='French')
+        texts = [
+            'the harbour was quiet that morning',
+            'a lighthouse keeper watched the harbour',
+            'green shutters banged in the wind',
+            'the baker opened the green shutters early',
+            '学校在哪里 学校很远',
+        ]
+        for element_id, text in enumerate(texts):
+            self.add_element(element_id, text)
+        index_item(self.book_item.id)
+
+    def add_element(self, element_id, text, translation=''):
+        return BookItemElement.objects.create(
+            book_item=self.book_item,
+            element_id=element_id,
+            element_type='p',
+            content=text,
+            translated_content=translation,
+            language=self.language,
+        )
+
+    def passage_of(self, element_id):
+        return Passage.objects.get(
+            book_item=self.book_item, first_element__lte=element_id, last_element__gte=element_id
+        )
+
+    def test_one_passage_per_group(self):
+        self.assertEqual(Passage.objects.filter(book_item=self.book_item).count(), 5)
+
+    def test_ranks_passages_with_more_matches_first(self):
+        results = search([self.book_item], 'green shutters wind')
+        self.assertEqual([passage.first_element for passage in results], [2, 3])
+
+    def test_cjk_question_matches(self):
+        results = search([self.book_item], '学校在哪里？')
+        self.assertEqual([passage.first_element for passage in results], [4])
+
+    def test_no_matching_terms(self):
+        self.assertEqual(search([self.book_item], 'submarine'), [])
+
+    def test_update_recomputes_covering_passage(self):
+        passage = self.passage_of(1)
+        element = BookItemElement.objects.get(book_item=self.book_item, element_id=1)
+        element.translated_content = 'un gardien de phare'
+        element.save()
+
+        update_index([(self.book_item.id, 1)])
+
+        self.assertEqual(self.passage_of(1).pk, passage.pk)
+        self.assertTrue(PassageTerm.objects.filter(passage=passage, term='phare').exists())
+        self.assertEqual([found.pk for found in search([self.book_item], 'phare')], [passage.pk])
+
+    def test_update_extends_item_for_appended_element(self):
+        first = self.passage_of(0)
+        self.add_element(5, 'a new paragraph about submarines')
+
+        update_index([(self.book_item.id, 5)])
+
+        self.assertEqual(Passage.objects.filter(book_item=self.book_item).count(), 6)
+        self.assertEqual(self.passage_of(0).pk, first.pk)
+        self.assertEqual(self.passage_of(5).position, 5)
+        self.assertEqual([found.first_element for found in search([self.book_item], 'submarines')], [5])
+
+    def test_update_rebuilds_item_for_element_between_passages(self):
+        self.add_element(7, 'a new paragraph about submarines')
+        update_index([(self.book_item.id, 7)])
+        self.add_element(6, 'the divers came back at noon')
+
+        update_index([(self.book_item.id, 6)])
+
+        self.assertEqual(self.passage_of(6).position, 5)
+        self.assertEqual(self.passage_of(7).position, 6)
+        self.assertEqual([found.first_element for found in search([self.book_item], 'divers')], [6])
+
+    def test_update_indexes_item_without_passages(self):
+        Passage.objects.filter(book_item=self.book_item).delete()
+
+        update_index([(self.book_item.id, 0)])
+
+        self.assertEqual(Passage.objects.filter(book_item=self.book_item).count(), 5)
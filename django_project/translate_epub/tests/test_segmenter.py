@@ -0,0 +1,69 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from translate_epub import segmenter
+from translate_epub.segmenter import count_tokens, join_chunks, split_sentences, split_text
+
+
+class CountTokensTests(SimpleTestCase):
+    def setUp(self):
+        # The estimate used when tiktoken isn't installed
+        patcher = mock.patch.object(segmenter, 'tiktoken', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_estimate_for_spaced_text(self):
+        self.assertEqual(count_tokens('The harbour was quiet.'), 6)
+
+    def test_estimate_counts_cjk_characters(self):
+        self.assertEqual(count_tokens('我们明天早上一起去学校上课。'), 15)
+        self.assertEqual(count_tokens('東京の空は青い'), 8)
+
+
+class SplitSentencesTests(SimpleTestCase):
+    def test_spaced_sentences(self):
+        self.assertEqual(split_sentences('One. "Two!"  Three'), [('One.', ' '), ('"Two!"', '  '), ('Three', '')])
+
+    def test_no_split_inside_words(self):
+        self.assertEqual(split_sentences('e.g. this...that'), [('e.g.', ' '), ('this...that', '')])
+
+    def test_unspaced_sentences(self):
+        self.assertEqual(
+            split_sentences('你好。「是的。」我们走吧！好'),
+            [('你好。', ''), ('「是的。」', ''), ('我们走吧！', ''), ('好', '')],
+        )
+
+    def test_trailing_punctuation(self):
+        self.assertEqual(split_sentences('终于到了。'), [('终于到了。', '')])
+
+
+class SplitTextTests(SimpleTestCase):
+    def assertSplit(self, text, max_tokens):
+        chunks = split_text(text, max_tokens)
+        self.assertGreater(len(chunks), 1)
+        for chunk, _ in chunks:
+            self.assertLessEqual(count_tokens(chunk), max_tokens)
+        self.assertEqual(join_chunks([chunk for chunk, _ in chunks], [separator for _, separator in chunks]), text)
+        return chunks
+
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(split_text('Short.', 100), [('Short.', '')])
+
+    def test_english_at_sentence_boundaries(self):
+        text = 'The harbour was quiet that morning. ' * 40 + 'The end.'
+        for chunk, _ in self.assertSplit(text, 50):
+            self.assertTrue(chunk.endswith('.'))
+
+    def test_chinese_at_sentence_boundaries(self):
+        text = '我们明天早上一起去学校上课。' * 60
+        for chunk, _ in self.assertSplit(text, 50):
+            self.assertTrue(chunk.endswith('。'))
+
+    def test_japanese_sentence_without_punctuation(self):
+        self.assertSplit('東京の空は今日もとても青くて静かです' * 40, 50)
+
+    def test_long_sentence_splits_at_spaces(self):
+        text = ' '.join(['word'] * 400)
+        for chunk, _ in self.assertSplit(text, 50):
+            self.assertFalse(chunk.startswith(' ') or chunk.endswith(' '))
@@ -0,0 +1,77 @@
+import hashlib
+import re
+import unicodedata
+
+from django.db.models import F
+
+from .chatgpt import API_MODEL, PROMPT_VERSION
+from .models import TranslationMemory
+from .telemetry import telemetry
+
+
+def normalize_text(text):
+    # Runs of spaces and tabs collapse, but line breaks are kept: they are rendered as <br/>
+    text = unicodedata.normalize('NFC', text).replace('\r\n', '\n')
+    text = re.sub(r'[^\S\n]+', ' ', text)
+    return re.sub(r' ?\n ?', '\n', text).strip()
+
+
+def memory_key(text, lang_from, lang_to, model=API_MODEL, prompt_version=PROMPT_VERSION):
+    parts = [normalize_text(text), lang_from, lang_to, model, prompt_version]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+class TranslationMemoryCache:
+    """Looks up and records translations in the shared TranslationMemory table.
+
+    Memory is shared across books, so boilerplate that has been translated once
+    for a language pair is never sent to the LLM again.
+    """
+
+    def __init__(self, lang_from, lang_to, model=API_MODEL, prompt_version=PROMPT_VERSION):
+        self.lang_from = lang_from
+        self.lang_to = lang_to
+        self.model = model
+        self.prompt_version = prompt_version
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return memory_key(text, self.lang_from, self.lang_to, self.model, self.prompt_version)
+
+    def lookup(self, texts):
+        """Return a list parallel to ``texts`` with the remembered translation or None."""
+        keys = [self.key(text) for text in texts]
+        with telemetry.stage('db'):
+            found = dict(
+                TranslationMemory.objects.filter(key__in=set(keys)).values_list('key', 'translated_text')
+            )
+            if found:
+                TranslationMemory.objects.filter(key__in=found.keys()).update(hit_count=F('hit_count') + 1)
+
+        translations = [found.get(key) for key in keys]
+        hits = sum(1 for translation in translations if translation is not None)
+        self.hits += hits
+        self.misses += len(translations) - hits
+        return translations
+
+    def store(self, pairs):
+        entries = {}
+        for text, translation in pairs:
+            if not normalize_text(text) or not translation:
+                continue
+            key = self.key(text)
+            entries[key] = TranslationMemory(
+                key=key,
+                lang_from=self.lang_from,
+                lang_to=self.lang_to,
+                model=self.model,
+                prompt_version=self.prompt_version,
+                source_text=text,
+                translated_text=translation,
+            )
+        with telemetry.stage('db'):
+            TranslationMemory.objects.bulk_create(entries.values(), ignore_conflicts=True)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
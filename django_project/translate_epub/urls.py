@@ -23,6 +23,7 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('book/<int:book_id>/', views.book_detail, name='book_detail'),
     path('book/<int:book_id>/ask_question/', views.ask_question, name='ask_question'),
+    path('question/<int:question_id>/answer_stream/', views.answer_stream, name='answer_stream'),
     path('book_item/<int:item_id>/', views.book_item_detail, name='book_item_detail'),
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
@@ -1,86 +1,176 @@
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render, redirect, get_object_or_404
-from django.core.paginator import Paginator
-from django.db.models import Count, Q
-from .models import Book, BookItem, Question, Answer, BookItemElement, Language
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Count, Prefetch, Q
+from .models import (
+    Book, BookItem, Question, Answer, BookItemElement, BookTranslationStats, Language, TranslationVersion,
+)
 from django.urls import reverse
-from .chatgpt import ChatGPT
+from .answers import answer_key, cached_answer, question_context, start_generation, stream_answer
+from .passage_index import update_index
 
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 
 
 @login_required
 def home(request):
-    books = Book.objects.all()
-    languages = Language.objects.all()
-    
+    # Progress comes from the precomputed BookTranslationStats rows: two queries for any number of books
+    books = Book.objects.prefetch_related(Prefetch(
+        'translation_stats',
+        queryset=BookTranslationStats.objects.filter(total__gt=0).select_related('language').order_by('language__name'),
+    ))
+
     book_data = []
     for book in books:
-        translations = BookItemElement.objects.filter(book_item__book=book).values('language').distinct()
-        translation_count = translations.count()
-        
         translation_links = []
-        for lang in languages:
-            if translations.filter(language=lang).exists():
-                translation_links.append({
-                    'language': lang,
-                    'url': reverse('translate_book', args=[book.id, lang.id])
-                })
-        
+        for stats in book.translation_stats.all():
+            translation_links.append({
+                'language': stats.language,
+                'stats': stats,
+                'url': reverse('translate_book', args=[book.id, stats.language_id])
+            })
+
         book_data.append({
             'book': book,
-            'translation_count': translation_count,
+            'translation_count': len(translation_links),
             'translations': translation_links,
             'detail_url': reverse('book_detail', args=[book.id]),
         })
     
     return render(request, 'translate_epub/home.html', {'book_data': book_data})
 
+def clean_translation(value):
+    # Browsers submit textarea line breaks as \r\n
+    return value.replace('\r\n', '\n').strip()
+
 @login_required
 @require_POST
 def update_element(request, element_id):
-    element = get_object_or_404(BookItemElement, id=element_id)
-    translation = request.POST.get('translation', '').strip()
+    element = get_object_or_404(BookItemElement.objects.select_related('book_item'), id=element_id)
+    translation = clean_translation(request.POST.get('translation', ''))
     complete = request.POST.get('complete') == 'true'
+    was_complete, was_machine_translated = element.complete, element.machine_translated
+    was_translation = element.translated_content
 
     # Save the translation and completion status
-    element.save_translation(translation, user=request.user)
-    element.complete = complete
-    element.save()
+    with transaction.atomic():
+        element.save_translation(translation, user=request.user)
+        element.complete = complete
+        element.save()
+        BookTranslationStats.apply(
+            element.book_item.book_id,
+            element.language_id,
+            complete=int(element.complete) - int(was_complete),
+            machine_translated=int(element.machine_translated) - int(was_machine_translated),
+        )
+    if element.translated_content != was_translation:
+        update_index([(element.book_item_id, element.element_id)])
 
     return JsonResponse({'success': True, 'complete': element.complete})
     # Return a JSON response indicating success
     # return JsonResponse({'success': True})
 
+REVIEW_PAGE_SIZE = 20
+
+
+def parse_cursor(value):
+    # Cursors are "<book_item_id>-<element_id>" of the last (or first) element of a page
+    try:
+        book_item_id, element_id = value.split('-')
+        return int(book_item_id), int(element_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def save_review(request, book, language):
+    """Save the submitted translations of one page with a bulk update and a bulk version insert."""
+    submitted = {}
+    for key, value in request.POST.items():
+        if key.startswith('translation_') and key[len('translation_'):].isdigit():
+            submitted[int(key[len('translation_'):])] = value
+    if not submitted:
+        return
+
+    now = timezone.now()
+    changed = []
+    versions = []
+    retranslated = []
+    complete_change = machine_translated_change = 0
+    for element in BookItemElement.objects.filter(id__in=submitted, book_item__book=book, language=language):
+        translation = clean_translation(submitted[element.id])
+        complete = request.POST.get(f'complete_{element.id}') == 'on'
+        translation_changed = translation != clean_translation(element.translated_content)
+        if not translation_changed and complete == element.complete:
+            continue
+
+        if translation_changed:
+            element.translated_content = translation
+            machine_translated_change -= int(element.machine_translated)
+            element.machine_translated = False
+            versions.append(element.build_version(user=request.user, is_machine_translation=False))
+            retranslated.append((element.book_item_id, element.element_id))
+        complete_change += int(complete) - int(element.complete)
+        element.complete = complete
+        element.updated_at = now
+        changed.append(element)
+
+    if not changed:
+        return
+    with transaction.atomic():
+        BookItemElement.objects.bulk_update(
+            changed, ['translated_content', 'complete', 'machine_translated', 'updated_at']
+        )
+        TranslationVersion.objects.bulk_create(versions)
+        BookTranslationStats.apply(
+            book.id, language.id, complete=complete_change, machine_translated=machine_translated_change
+        )
+        update_index(retranslated)
+
+
 def translate_book(request, book_id, language_id):
     book = get_object_or_404(Book, id=book_id)
     language = get_object_or_404(Language, id=language_id)
-    show_completed = request.GET.get('show_completed', False)
-
-    if show_completed:
-        book_item_elements = BookItemElement.objects.filter(book_item__book=book, language=language)
-    else:
-        book_item_elements = BookItemElement.objects.filter(book_item__book=book, language=language, complete=False)
-
-    paginator = Paginator(book_item_elements, 20)  # Show 20 elements per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    show_completed = bool(request.GET.get('show_completed'))
 
     if request.method == 'POST':
-        for element in page_obj:
-            translation = request.POST.get(f'translation_{element.id}')
-            complete = request.POST.get(f'complete_{element.id}')
-            # element.translated_content = translation
-            element.save_translation(translation, user=request.user)
-            element.complete = complete == 'on'
-            element.save()
+        save_review(request, book, language)
+
+    book_item_elements = BookItemElement.objects.filter(book_item__book=book, language=language)
+    if not show_completed:
+        book_item_elements = book_item_elements.filter(complete=False)
+
+    # Keyset pagination on (book_item, element_id): no COUNT(*) and no OFFSET scan
+    after = parse_cursor(request.GET.get('after'))
+    before = parse_cursor(request.GET.get('before'))
+    if before:
+        book_item_id, element_id = before
+        elements = list(book_item_elements.filter(
+            Q(book_item_id__lt=book_item_id) | Q(book_item_id=book_item_id, element_id__lt=element_id)
+        ).order_by('-book_item_id', '-element_id')[:REVIEW_PAGE_SIZE + 1])
+        has_previous = len(elements) > REVIEW_PAGE_SIZE
+        elements = elements[:REVIEW_PAGE_SIZE][::-1]
+        has_next = True
+    else:
+        if after:
+            book_item_id, element_id = after
+            book_item_elements = book_item_elements.filter(
+                Q(book_item_id__gt=book_item_id) | Q(book_item_id=book_item_id, element_id__gt=element_id)
+            )
+        elements = list(book_item_elements.order_by('book_item_id', 'element_id')[:REVIEW_PAGE_SIZE + 1])
+        has_next = len(elements) > REVIEW_PAGE_SIZE
+        elements = elements[:REVIEW_PAGE_SIZE]
+        has_previous = after is not None
 
     context = {
         'book': book,
         'language': language,
-        'page_obj': page_obj,
+        'elements': elements,
         'show_completed': show_completed,
+        'stats': BookTranslationStats.objects.filter(book=book, language=language).first(),
+        'previous_cursor': f'{elements[0].book_item_id}-{elements[0].element_id}' if elements and has_previous else None,
+        'next_cursor': f'{elements[-1].book_item_id}-{elements[-1].element_id}' if elements and has_next else None,
     }
     return render(request, 'translate_epub/translate_book.html', context)
 
@@ -111,39 +201,43 @@ def book_item_detail(request, item_id):
     return render(request, 'translate_epub/book_item_detail.html', context)
 
 
-def ask_question(request, book_id):
+async def ask_question(request, book_id):
     if request.method == 'POST':
-        book = get_object_or_404(Book, id=book_id)
+        book = await aget_object_or_404(Book, id=book_id)
         selected_items = request.POST.getlist('selected_items')
         question_title = request.POST.get('question_title')
         question_content = request.POST.get('question_content')
 
         # Create a new Question object
-        question = Question.objects.create(
+        question = await Question.objects.acreate(
             book=book,
             title=question_title,
             content=question_content
         )
 
         # Associate selected BookItems with the Question
-        book_items = BookItem.objects.filter(id__in=selected_items)
-        question.book_items.set(book_items)
-
-        # Prepare content for AI processing
-        content = "\n".join([item.content for item in book_items])
-
-        # Use ChatGPT to generate an answer
-        chatgpt = ChatGPT()
-        ai_response = chatgpt.ask(content, question_content)
-
-        # Create a new Answer object
-        Answer.objects.create(
-            question=question,
-            content=ai_response
-        )
+        book_items = [book_item async for book_item in BookItem.objects.filter(id__in=selected_items)]
+        await question.book_items.aset(book_items)
+
+        context = await question_context(book_items, question_content)
+        cached = await cached_answer(answer_key(question_content, context))
+        if cached is not None:
+            await Answer.objects.acreate(question=question, content=cached)
+        else:
+            # The answer is streamed by a task on the event loop; this request doesn't wait for the LLM
+            answer = await Answer.objects.acreate(question=question, content='', complete=False)
+            await start_generation(answer, context)
 
         return redirect(reverse('book_item_detail', args=[book_items[0].id]))
 
     return redirect(reverse('book_detail', args=[book_id]))
 
 
+async def answer_stream(request, question_id):
+    """Server-sent events with the answer to a question as it is written."""
+    answer = await aget_object_or_404(Answer, question_id=question_id)
+    response = StreamingHttpResponse(stream_answer(answer), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keeps nginx from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,257 @@
+import os
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Book, Language, TranslationJob, WorkUnit
+from .bulk_writer import TranslationWriter
+from .epub_handler import StreamingTEPUB
+from .idml_handler import IDMLParser, IDMLWriter
+
+
+def story_names(zip_ref):
+    return [
+        file_name for file_name in zip_ref.namelist()
+        if file_name.startswith('Stories/Story_') and file_name.endswith('.xml')
+    ]
+
+
+def enqueue(file_path, lang_from, lang_to, options):
+    """Create a job for the book with one work unit per epub document or idml story."""
+    language, _ = Language.objects.get_or_create(name=lang_to)
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        if file_path.endswith('.epub'):
+            # Same Book row as a TEPUB run on the file
+            book, _ = Book.objects.get_or_create(file_name=os.path.basename(file_path))
+            names = list(StreamingTEPUB.read_manifest(zip_ref))
+        else:
+            book, _ = Book.objects.get_or_create(file_name=file_path)
+            names = story_names(zip_ref)
+
+    with transaction.atomic():
+        job = TranslationJob.objects.create(
+            book=book, language=language, file_path=file_path, lang_from=lang_from, options=options,
+        )
+        WorkUnit.objects.bulk_create([WorkUnit(job=job, name=name) for name in names])
+    return job
+
+
+def claim_unit(worker, lease_seconds, max_attempts):
+    """Lease the next available unit to ``worker``, or return None if there is none.
+
+    Units whose lease expired (their worker died or hung) are handed out again.
+    SKIP LOCKED lets any number of workers claim at once without waiting on
+    each other's row locks.
+    """
+    while True:
+        now = timezone.now()
+        # Resolved up front so the locking query doesn't join (and lock) the job rows
+        job_ids = list(TranslationJob.objects.filter(status=TranslationJob.PENDING).values_list('id', flat=True))
+        if not job_ids:
+            return None
+        with transaction.atomic():
+            unit = (
+                WorkUnit.objects.select_for_update(skip_locked=True)
+                .filter(job_id__in=job_ids, status__in=[WorkUnit.PENDING, WorkUnit.RUNNING])
+                .exclude(status=WorkUnit.RUNNING, lease_expires_at__gte=now)
+                .order_by('id')
+                .first()
+            )
+            if unit is None:
+                return None
+            if unit.attempts >= max_attempts:
+                unit.status = WorkUnit.FAILED
+                unit.error = unit.error or 'lease expired too many times'
+                unit.save(update_fields=['status', 'error', 'updated_at'])
+                TranslationJob.objects.filter(pk=unit.job_id).update(status=TranslationJob.FAILED)
+                continue
+            unit.status = WorkUnit.RUNNING
+            unit.worker = worker
+            unit.attempts += 1
+            unit.heartbeat_at = now
+            unit.lease_expires_at = now + timedelta(seconds=lease_seconds)
+            unit.save(update_fields=['status', 'worker', 'attempts', 'heartbeat_at', 'lease_expires_at', 'updated_at'])
+            return unit
+
+
+def renew_lease(unit, lease_seconds):
+    """Extend the lease; False if the unit has been taken over by another worker."""
+    now = timezone.now()
+    return WorkUnit.objects.filter(pk=unit.pk, worker=unit.worker, status=WorkUnit.RUNNING).update(
+        heartbeat_at=now, lease_expires_at=now + timedelta(seconds=lease_seconds), updated_at=now,
+    ) == 1
+
+
+def complete_unit(unit):
+    return WorkUnit.objects.filter(pk=unit.pk, worker=unit.worker, status=WorkUnit.RUNNING).update(
+        status=WorkUnit.DONE, lease_expires_at=None, error='', updated_at=timezone.now(),
+    ) == 1
+
+
+def fail_unit(unit, error, max_attempts):
+    status = WorkUnit.FAILED if unit.attempts >= max_attempts else WorkUnit.PENDING
+    updated = WorkUnit.objects.filter(pk=unit.pk, worker=unit.worker, status=WorkUnit.RUNNING).update(
+        status=status, lease_expires_at=None, error=error, updated_at=timezone.now(),
+    )
+    if updated and status == WorkUnit.FAILED:
+        TranslationJob.objects.filter(pk=unit.job_id).update(status=TranslationJob.FAILED)
+
+
+def claim_assembly(job_id):
+    """Mark the job as assembling if all its units are done; only one worker gets it."""
+    with transaction.atomic():
+        job = TranslationJob.objects.select_for_update().get(pk=job_id)
+        if job.status != TranslationJob.PENDING or job.units.exclude(status=WorkUnit.DONE).exists():
+            return None
+        job.status = TranslationJob.ASSEMBLING
+        job.save(update_fields=['status', 'updated_at'])
+    return job
+
+
+class LeaseKeeper(threading.Thread):
+    """Renews a unit's lease in the background while it is being translated."""
+
+    def __init__(self, unit, lease_seconds):
+        super().__init__(daemon=True)
+        self.unit = unit
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.lease_seconds / 3):
+                if not renew_lease(self.unit, self.lease_seconds):
+                    self.lost = True
+                    return
+        finally:
+            # This thread has its own database connection
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.join()
+
+
+class QueueWorker:
+    def __init__(self, worker, lease_seconds=300, max_attempts=3):
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # (job id, tepub, book, book_items, manifest) of the epub job this worker last took a unit from
+        self.prepared = None
+
+    def make_tepub(self, job):
+        # Output goes next to the book, wherever the worker was started
+        return StreamingTEPUB(
+            job.file_path, job.lang_from, job.language.name,
+            output_dir=os.path.dirname(os.path.abspath(job.file_path)), **job.options,
+        )
+
+    def prepare(self, job):
+        """Stored items and manifest of ``job``'s book, loaded once for all the units taken from it."""
+        if self.prepared is None or self.prepared[0] != job.pk:
+            tepub = self.make_tepub(job)
+            book, book_items = tepub.prepare_book()
+            with zipfile.ZipFile(job.file_path, 'r') as zip_ref:
+                manifest = tepub.read_manifest(zip_ref)
+            self.prepared = (job.pk, tepub, book, book_items, manifest)
+        return self.prepared[1:]
+
+    def translate_document(self, job, unit):
+        tepub, book, book_items, manifest = self.prepare(job)
+        memory = tepub.targets[0].memory
+        hits, misses = memory.hits, memory.misses
+        with zipfile.ZipFile(job.file_path, 'r') as zip_ref, \
+                TranslationWriter(tepub.flush_every, tepub.flush_seconds) as writer, \
+                ThreadPoolExecutor(max_workers=tepub.concurrency) as executor:
+            item_index, item_info = manifest[unit.name]
+            # The render is cached with the translations, so assembling the book later needs no LLM calls
+            tepub.translate_document(book, book_items, item_index, item_info, zip_ref.read(unit.name), writer, executor)
+        return memory.hits - hits, memory.misses - misses
+
+    def translate_story(self, job, unit):
+        idml_parser = IDMLParser(job.file_path, job.lang_from, job.language.name, **job.options)
+        idml_parser.targets[0].language = job.language
+        with zipfile.ZipFile(job.file_path, 'r') as zip_ref, \
+                TranslationWriter(idml_parser.flush_every, idml_parser.flush_seconds) as idml_parser.writer:
+            if idml_parser.stream:
+                idml_parser.parse_story_stream(job.book, unit.name, zip_ref)
+            else:
+                idml_parser.parse_story(job.book, unit.name, zip_ref.read(unit.name))
+        memory = idml_parser.targets[0].memory
+        return memory.hits, memory.misses
+
+    def assemble(self, job):
+        """Build the translated file, next to the book, from stored translations and renders."""
+        if job.file_path.endswith('.epub'):
+            tepub = self.make_tepub(job)
+            tepub.translate_book()
+            output_path = tepub.get_output_name(tepub.targets[0])
+        else:
+            output_path = f"{os.path.splitext(job.file_path)[0]}_{job.lang_from}_to_{job.language.name}.idml"
+            IDMLWriter(job.file_path, output_path, job.language.name, job.options.get('stream', False)).write()
+        job.output_path = os.path.abspath(output_path)
+        job.status = TranslationJob.DONE
+        job.save(update_fields=['output_path', 'status', 'updated_at'])
+        print(f"Job {job.id} assembled: {job.output_path}")
+
+    def assemble_ready(self):
+        # Picks up jobs whose last worker finished its unit but died before assembling
+        job_ids = TranslationJob.objects.filter(status=TranslationJob.PENDING).exclude(
+            units__status__in=[WorkUnit.PENDING, WorkUnit.RUNNING, WorkUnit.FAILED]
+        ).values_list('id', flat=True)
+        for job_id in list(job_ids):
+            job = claim_assembly(job_id)
+            if job is not None:
+                self.assemble(job)
+
+    def process(self, unit):
+        job = TranslationJob.objects.select_related('book', 'language').get(pk=unit.job_id)
+        print(f"[{self.worker}] job {job.id}: {unit.name} (attempt {unit.attempts})")
+        with LeaseKeeper(unit, self.lease_seconds) as keeper:
+            try:
+                if job.file_path.endswith('.epub'):
+                    hits, misses = self.translate_document(job, unit)
+                else:
+                    hits, misses = self.translate_story(job, unit)
+            except Exception:
+                print(f"[{self.worker}] {unit.name} failed")
+                # The cached items may have been changed without being saved
+                self.prepared = None
+                fail_unit(unit, traceback.format_exc(), self.max_attempts)
+                return
+
+        if keeper.lost or not complete_unit(unit):
+            # Another worker took the unit over; its result wins
+            print(f"[{self.worker}] lost the lease on {unit.name}")
+            return
+        print(f"[{self.worker}] {unit.name} done ({hits} memory hits, {misses} misses)")
+
+        job = claim_assembly(job.pk)
+        if job is not None:
+            self.assemble(job)
+
+    def run(self, poll_seconds=0):
+        """Work until the queue is empty, or forever polling every ``poll_seconds``."""
+        processed = 0
+        while True:
+            unit = claim_unit(self.worker, self.lease_seconds, self.max_attempts)
+            if unit is None:
+                self.assemble_ready()
+                if not poll_seconds:
+                    return processed
+                time.sleep(poll_seconds)
+                continue
+            self.process(unit)
+            processed += 1